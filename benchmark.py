@@ -0,0 +1,595 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the training data pipeline.
+#
+# Each subcommand prints its results as one JSON object per line so runs
+# can be collected and compared over time.
+
+import argparse
+import copy
+import glob
+import gzip
+import io
+import json
+import multiprocessing as mp
+import resource
+import struct
+import time
+import yaml
+
+import chunkcodec
+import chunkparser
+import numpy as np
+import ringbuffer as rb
+import tensorflow as tf
+import tfpipeline
+import tfprocess
+import train
+
+
+def pipe_producer(writer, record):
+    while True:
+        writer.send_bytes(record)
+
+
+def ring_producer(ring, record):
+    while True:
+        ring.put(record)
+
+
+def bench_transport(args):
+    """
+    Move v5 sized records from N producer processes to the parent over
+    pipes and over shared memory rings, consuming them round robin like
+    ChunkParser.v5_gen does.
+    """
+    record_size = struct.calcsize(chunkparser.V5_STRUCT_STRING)
+    record = bytes(record_size)
+    for workers in args.workers:
+        for transport in args.transports:
+            readers = []
+            processes = []
+            for _ in range(workers):
+                if transport == 'shm':
+                    ring = rb.SharedRingBuffer(record_size, args.slots)
+                    p = mp.Process(target=ring_producer, args=(ring, record))
+                    readers.append(ring)
+                else:
+                    read, write = mp.Pipe(duplex=False)
+                    p = mp.Process(target=pipe_producer, args=(write, record))
+                    readers.append(read)
+                p.daemon = True
+                p.start()
+                processes.append(p)
+
+            received = 0
+            start = time.perf_counter()
+            cpu_start = time.process_time()
+            while received < args.records:
+                for r in readers:
+                    if transport == 'shm':
+                        # Copy out of the slot, as the shuffle buffer does.
+                        bytes(r.get())
+                        r.release()
+                    else:
+                        r.recv_bytes()
+                    received += 1
+            elapsed = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+
+            for p in processes:
+                p.terminate()
+                p.join()
+            for r in readers:
+                r.close()
+
+            print(
+                json.dumps({
+                    'benchmark': 'transport',
+                    'transport': transport,
+                    'workers': workers,
+                    'records': received,
+                    'seconds': elapsed,
+                    'records_per_sec': received / elapsed,
+                    'mb_per_sec': received * record_size / elapsed / 1e6,
+                    'parent_cpu_per_record_us': cpu / received * 1e6,
+                }))
+
+
+def gzip_stream_decompress(data):
+    """
+    Decompress the way ChunkParser used to, through gzip.open in blocks of
+    256 records.
+    """
+    out = []
+    with gzip.open(io.BytesIO(data), 'rb') as f:
+        block_size = 256 * struct.calcsize(chunkparser.V5_STRUCT_STRING)
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            out.append(block)
+    return b''.join(out)
+
+
+def bench_decompress(args):
+    """
+    Decompress a sample of chunk files with every codec, re-encoding the
+    sample for the codecs it isn't stored in.
+    """
+    record_sizes = {
+        chunkparser.V5_VERSION: struct.calcsize(chunkparser.V5_STRUCT_STRING),
+        chunkparser.V4_VERSION: struct.calcsize(chunkparser.V4_STRUCT_STRING),
+        chunkparser.V3_VERSION: struct.calcsize(chunkparser.V3_STRUCT_STRING),
+    }
+    filenames = sorted(glob.glob(args.input))[:args.files]
+    files = []
+    for filename in filenames:
+        with open(filename, 'rb') as f:
+            files.append(f.read())
+    chunks = [chunkcodec.decompress(data) for data in files]
+    total_bytes = sum(len(chunk) for chunk in chunks)
+    records = sum(
+        len(chunk) // record_sizes[chunk[0:4]] for chunk in chunks
+        if chunk[0:4] in record_sizes)
+
+    runs = []
+    for name in args.codecs:
+        if name not in chunkcodec.available_codecs():
+            print(json.dumps({'benchmark': 'decompress', 'codec': name,
+                              'skipped': 'not installed'}))
+            continue
+        codec = chunkcodec.CODECS[name]
+        payloads = [
+            data if chunkcodec.detect_codec(data) == name else
+            codec.compress(chunk) for data, chunk in zip(files, chunks)
+        ]
+        if name == 'gzip':
+            if chunkcodec.igzip is not None:
+                runs.append((name, 'isal', chunkcodec.igzip.decompress,
+                             payloads))
+            runs.append((name, 'zlib', chunkcodec.zlib_gunzip, payloads))
+            runs.append((name, 'gzip.open', gzip_stream_decompress, payloads))
+        else:
+            runs.append((name, name, codec.decompress, payloads))
+
+    for name, backend, decompress, payloads in runs:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for data in payloads:
+                decompress(data)
+        elapsed = time.perf_counter() - start
+        print(
+            json.dumps({
+                'benchmark': 'decompress',
+                'codec': name,
+                'backend': backend,
+                'files': len(payloads),
+                'ratio': total_bytes / sum(len(data) for data in payloads),
+                'mb_per_sec': total_bytes * args.repeat / elapsed / 1e6,
+                'records_per_sec': records * args.repeat / elapsed,
+            }))
+
+
+def bench_input(args):
+    """
+    Time the training input pipelines of train.create_dataset on the
+    training data of a config, consuming batches as fast as they come.
+    """
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.safe_load(f)
+    dataset_cfg = cfg['dataset']
+    input_train = dataset_cfg.get('input_train', dataset_cfg.get('input'))
+    chunks = train.find_chunks([input_train],
+                               num_chunks=dataset_cfg.get('num_chunks'),
+                               allow_less=True)
+    for pipeline in args.pipelines:
+        run_cfg = copy.deepcopy(cfg)
+        run_cfg['dataset']['pipeline'] = pipeline
+        dataset, parser = train.create_dataset(chunks, run_cfg)
+        batches = iter(dataset)
+        for _ in range(args.warmup):
+            next(batches)
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        for _ in range(args.batches):
+            next(batches)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        if parser is not None:
+            parser.shutdown()
+        positions = args.batches * cfg['training']['batch_size']
+        print(
+            json.dumps({
+                'benchmark': 'input',
+                'pipeline': pipeline,
+                'batches': args.batches,
+                'positions_per_sec': positions / elapsed,
+                'parent_cpu_per_position_us': cpu / positions * 1e6,
+            }))
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """
+    Peak resident set size in MB of this process, or with RUSAGE_CHILDREN
+    of its largest finished child.
+    """
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def time_stage(items, fn):
+    """
+    Apply fn to each of items. Returns the list of results and the stage's
+    timings.
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    out = [fn(item) for item in items]
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    return out, {
+        'items': len(items),
+        'seconds': elapsed,
+        'cpu_seconds': cpu,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+
+def bench_parser_stages(args, chunks, parser):
+    """
+    Run each ChunkParser stage on its own in this process, over the whole
+    output of the stage before it.
+    """
+    # Shard blocks are read and decompressed in one go, so those are only
+    # timed end to end.
+    filenames = [c for c in chunks if isinstance(c, str)][:args.files]
+    stages = []
+    files, timing = time_stage(filenames, read_file)
+    stages.append(('read', timing))
+    chunkdata, timing = time_stage(files, chunkcodec.decompress)
+    stages.append(('decompress', timing))
+    # Positions in the files, before down-sampling.
+    total = sum(
+        len(c) // parser.record_size(bytes(c[0:4])) for c in chunkdata
+        if parser.record_size(bytes(c[0:4])))
+    records, timing = time_stage(chunkdata,
+                                 lambda c: list(parser.sample_record(c)))
+    stages.append(('sample', timing))
+    records = [r for rs in records for r in rs]
+    blocks, timing = time_stage(
+        [records],
+        lambda rs: list(parser.shuffle_gen(iter(rs), args.shuffle_size)))
+    stages.append(('shuffle', timing))
+    # shuffle_gen hands out blocks of up to batch_size records.
+    batches, timing = time_stage(blocks[0], parser.convert_v5_batch)
+    stages.append(('decode', timing))
+    _, timing = time_stage(batches, lambda b: tuple(x.tobytes() for x in b))
+    stages.append(('batch', timing))
+
+    for name, timing in stages:
+        positions = total if name in ('read', 'decompress') else len(records)
+        print(
+            json.dumps(
+                dict({
+                    'benchmark': 'parser',
+                    'stage': name,
+                    'positions': positions,
+                    'positions_per_sec': positions / timing['seconds'],
+                }, **timing)))
+
+
+def bench_parser(args):
+    """
+    Time ChunkParser on a directory or glob of chunks, end to end through
+    parse() with its worker processes, or one stage at a time.
+    """
+    chunks = train.find_chunks([args.input])
+    if not chunks:
+        raise ValueError('No chunks found in {}'.format(args.input))
+    chunkparser.ChunkParser.BATCH_SIZE = args.batch_size
+    parser = chunkparser.ChunkParser(
+        chunks if args.mode == 'parse' else [],
+        args.input_format,
+        shuffle_size=args.shuffle_size,
+        sample=args.sample,
+        batch_size=args.batch_size,
+        workers=args.workers if args.mode == 'parse' else 1,
+        worker_decode=args.worker_decode,
+        transport=args.transport)
+    if args.mode == 'stages':
+        parser.shutdown()
+        bench_parser_stages(args, chunks, parser)
+        return
+
+    batches = parser.parse()
+    for _ in range(args.warmup):
+        next(batches)
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    for _ in range(args.batches):
+        next(batches)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    parser.shutdown()
+    # The workers were joined, so their usage is now counted.
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    positions = args.batches * args.batch_size
+    print(
+        json.dumps({
+            'benchmark': 'parser',
+            'stage': 'parse',
+            'workers': args.workers,
+            'shuffle_size': args.shuffle_size,
+            'batch_size': args.batch_size,
+            'positions': positions,
+            'seconds': elapsed,
+            'cpu_seconds': cpu,
+            'worker_cpu_seconds': children.ru_utime + children.ru_stime,
+            'positions_per_sec': positions / elapsed,
+            'peak_rss_mb': peak_rss_mb(),
+            'worker_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN),
+        }))
+
+
+def synthetic_batch(tfp, batch_size):
+    """
+    A random training batch in the input and target formats of tfp.
+    """
+    if tfp.packed_planes:
+        x = np.random.randint(0,
+                              256,
+                              size=(batch_size, tfpipeline.PACKED_PLANES_SIZE),
+                              dtype=np.uint8)
+    else:
+        x = np.random.randint(0, 2, size=(batch_size, 112, 64))
+        x = x.astype(np.float32)
+    probs = -np.ones((batch_size, 1858), dtype=np.float32)
+    for i in range(batch_size):
+        legal = np.random.choice(1858, 30, replace=False)
+        probs[i, legal] = np.random.dirichlet(np.ones(30))
+    y = tf.constant(probs)
+    if tfp.sparse_policy:
+        y = tfpipeline.sparse_policy_targets(y)
+    z = np.eye(3, dtype=np.float32)[np.random.randint(3, size=batch_size)]
+    q = np.eye(3, dtype=np.float32)[np.random.randint(3, size=batch_size)]
+    m = np.random.randint(0, 200, size=batch_size).astype(np.float32)
+    return (tf.constant(x), y, tf.constant(z), tf.constant(q),
+            tf.constant(m))
+
+
+def bench_jit(args):
+    """
+    Time the training and test steps of a config's network on synthetic
+    batches, with and without XLA compilation.
+    """
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.safe_load(f)
+    for jit_compile in [False, True]:
+        run_cfg = copy.deepcopy(cfg)
+        run_cfg['training']['jit_compile'] = jit_compile
+        tfp = tfprocess.TFProcess(run_cfg)
+        tfp.init_net_v2(summaries=False)
+        batch = synthetic_batch(tfp, args.batch_size)
+        steps = [('train', lambda: tfp.train_step((batch, )),
+                  lambda: tfp.grad_norm.numpy()),
+                 ('test',
+                  lambda: tfp.calculate_test_summaries_inner_loop(*batch),
+                  lambda: None)]
+        for name, step, sync in steps:
+            # The first call traces and compiles.
+            start = time.perf_counter()
+            out = step()
+            sync()
+            compile_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(args.steps):
+                out = step()
+            if out is not None:
+                out[0].numpy()
+            sync()
+            elapsed = time.perf_counter() - start
+            print(
+                json.dumps({
+                    'benchmark': 'jit',
+                    'config': run_cfg['name'],
+                    'step': name,
+                    'jit_compile': jit_compile,
+                    'batch_size': args.batch_size,
+                    'first_call_seconds': compile_time,
+                    'step_ms': elapsed / args.steps * 1e3,
+                    'positions_per_sec':
+                    args.steps * args.batch_size / elapsed,
+                }))
+
+
+def bench_accum(args):
+    """
+    Time training steps with batch splits on synthetic batches, and on a
+    GPU the peak memory TensorFlow allocated on it during them.
+    """
+    with open(args.cfg, 'r') as f:
+        cfg = yaml.safe_load(f)
+    cfg['training']['num_batch_splits'] = args.splits
+    cfg['training']['average_batch_splits'] = args.average
+    tfp = tfprocess.TFProcess(cfg)
+    tfp.init_net_v2(summaries=False)
+    batches = tuple(
+        synthetic_batch(tfp, args.batch_size // args.splits)
+        for _ in range(args.splits))
+    gpu = bool(tf.config.list_logical_devices('GPU'))
+    device = 'GPU:0' if gpu else 'CPU:0'
+    # The first call traces the step and creates the optimizer slots.
+    tfp.train_step(batches)
+    tfp.grad_norm.numpy()
+    if gpu:
+        tf.config.experimental.reset_memory_stats(device)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        tfp.train_step(batches)
+    tfp.grad_norm.numpy()
+    elapsed = time.perf_counter() - start
+    weights = sum(w.numpy().nbytes for w in tfp.model.trainable_weights)
+    result = {
+        'benchmark': 'accum',
+        'config': cfg['name'],
+        'device': device,
+        'batch_size': args.batch_size,
+        'splits': args.splits,
+        'average': args.average,
+        'step_ms': elapsed / args.steps * 1e3,
+        'peak_mb': None,
+        'weights_mb': weights / 2**20,
+    }
+    if gpu:
+        result['peak_mb'] = tf.config.experimental.get_memory_info(
+            device)['peak'] / 2**20
+    else:
+        result['note'] = 'peak memory is only tracked on GPU'
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark parts of the training data pipeline.')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    transport = subparsers.add_parser(
+        'transport', help='worker to trainer record transport')
+    transport.add_argument('--workers',
+                           type=int,
+                           nargs='+',
+                           default=[4, 16, 64],
+                           help='worker counts to run')
+    transport.add_argument('--transports',
+                           nargs='+',
+                           default=['pipe', 'shm'],
+                           choices=['pipe', 'shm'])
+    transport.add_argument('--records',
+                           type=int,
+                           default=200000,
+                           help='records to receive per run')
+    transport.add_argument('--slots',
+                           type=int,
+                           default=256,
+                           help='ring slots per worker')
+    transport.set_defaults(func=bench_transport)
+
+    decompress = subparsers.add_parser('decompress',
+                                       help='chunk decompression codecs')
+    decompress.add_argument('input', help='glob of sample chunk files')
+    decompress.add_argument('--files',
+                            type=int,
+                            default=1000,
+                            help='maximum number of files to sample')
+    decompress.add_argument('--codecs',
+                            nargs='+',
+                            default=list(chunkcodec.CODECS),
+                            choices=list(chunkcodec.CODECS))
+    decompress.add_argument('--repeat',
+                            type=int,
+                            default=3,
+                            help='passes over the sample')
+    decompress.set_defaults(func=bench_decompress)
+
+    pipeline = subparsers.add_parser('input',
+                                     help='training input pipelines')
+    pipeline.add_argument('--cfg',
+                          required=True,
+                          help='training config with the data to read')
+    pipeline.add_argument('--pipelines',
+                          nargs='+',
+                          default=['chunkparser', 'tf'],
+                          choices=['chunkparser', 'tf'])
+    pipeline.add_argument('--batches',
+                          type=int,
+                          default=200,
+                          help='batches to time per pipeline')
+    pipeline.add_argument('--warmup',
+                          type=int,
+                          default=10,
+                          help='batches read before timing')
+    pipeline.set_defaults(func=bench_input)
+
+    chunk_parser = subparsers.add_parser(
+        'parser', help='ChunkParser throughput by stage')
+    chunk_parser.add_argument('input',
+                              help='chunk directory or glob, e.g. from '
+                              'generate_test_data.py')
+    chunk_parser.add_argument('--mode',
+                              default='parse',
+                              choices=['parse', 'stages'],
+                              help='run parse() end to end, or time read, '
+                              'decompress, sample, shuffle, decode and batch '
+                              'one after another in this process')
+    chunk_parser.add_argument('--workers', type=int, default=4)
+    chunk_parser.add_argument('--shuffle-size', type=int, default=10000)
+    chunk_parser.add_argument('--batch-size', type=int, default=1024)
+    chunk_parser.add_argument('--input-format',
+                              type=int,
+                              default=1,
+                              help='expected input format of the records')
+    chunk_parser.add_argument('--sample',
+                              type=int,
+                              default=1,
+                              help='keep 1 in this many records')
+    chunk_parser.add_argument('--worker-decode', action='store_true')
+    chunk_parser.add_argument('--transport',
+                              default='pipe',
+                              choices=['pipe', 'shm'])
+    chunk_parser.add_argument('--batches',
+                              type=int,
+                              default=200,
+                              help='batches to time with parse()')
+    chunk_parser.add_argument('--warmup',
+                              type=int,
+                              default=10,
+                              help='batches read before timing')
+    chunk_parser.add_argument('--files',
+                              type=int,
+                              default=100,
+                              help='chunk files to run through the stages')
+    chunk_parser.set_defaults(func=bench_parser)
+
+    jit = subparsers.add_parser('jit',
+                                help='training steps with and without XLA')
+    jit.add_argument('--cfg',
+                     default='configs/128x10-t60-2.yaml',
+                     help='training config of the network to time')
+    jit.add_argument('--batch-size', type=int, default=256)
+    jit.add_argument('--steps',
+                     type=int,
+                     default=20,
+                     help='steps to time after the first')
+    jit.set_defaults(func=bench_jit)
+
+    accum = subparsers.add_parser(
+        'accum', help='training steps accumulating batch splits')
+    accum.add_argument('--cfg',
+                       default='configs/128x10-t60-2.yaml',
+                       help='training config of the network to time')
+    accum.add_argument('--batch-size',
+                       type=int,
+                       default=1024,
+                       help='positions per step, over all splits')
+    accum.add_argument('--splits', type=int, default=4)
+    accum.add_argument('--average',
+                       action='store_true',
+                       help='average the gradients of the splits')
+    accum.add_argument('--steps',
+                       type=int,
+                       default=10,
+                       help='steps to time after the first')
+    accum.set_defaults(func=bench_accum)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+#
+# On-disk cache of decompressed training chunks
+# Lets repeated passes over a fixed window skip gzip entirely
+
+import contextlib
+import fcntl
+import hashlib
+import multiprocessing as mp
+import mmap
+import os
+import struct
+import tempfile
+import time
+import unittest
+
+
+class ChunkCache:
+    """
+    Keeps decompressed copies of chunk files in a cache directory, and
+    serves them from mmap.
+
+    Each cached chunk is one file holding the whole records of the chunk
+    back to back, followed by a trailer with the record size and count,
+    so record i starts at byte i * record_size. Cached files are keyed by
+    the source path, size and modification time. The least recently used
+    files are removed before a new one would take the cache past
+    max_bytes.
+
+    The cache is safe to share between processes: files are written to a
+    temporary name and renamed into place, and a file being evicted stays
+    readable by anyone who has it mapped already. The total size of the
+    cached files is kept in a file of the cache directory, and updated
+    under a lock on it together with the files it counts, so the budget
+    holds for all the processes together.
+    """
+    TRAILER = struct.Struct('<4sIQ')
+    MAGIC = b'LZCC'
+    SIZE = struct.Struct('<Q')
+
+    def __init__(self, path, max_bytes):
+        """
+        Args:
+            path: Cache directory, created if missing
+            max_bytes: Disk budget for the cache in bytes
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size_path = os.path.join(path, 'size')
+        os.makedirs(path, exist_ok=True)
+
+    def cache_filename(self, filename):
+        st = os.stat(filename)
+        key = '{}:{}:{}'.format(os.path.abspath(filename), st.st_size,
+                                st.st_mtime_ns)
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.path, digest[:2], digest + '.rec')
+
+    def load(self, filename):
+        """
+        Look up chunk filename in the cache.
+
+        Returns:
+            (record_size, data) where data is a read only memoryview of the
+            records backed by an mmap of the cache file, or None if the
+            chunk is not cached.
+        """
+        path = self.cache_filename(filename)
+        try:
+            with open(path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # ValueError is an empty file.
+            return None
+        # Mark as recently used.
+        os.utime(path)
+        magic, record_size, num_records = self.TRAILER.unpack(
+            mm[-self.TRAILER.size:])
+        if magic != self.MAGIC:
+            return None
+        return record_size, memoryview(mm)[:record_size * num_records]
+
+    def store(self, filename, data, record_size):
+        """
+        Add the decompressed contents of chunk filename to the cache. A
+        trailing partial record is dropped.
+
+        Returns:
+            (record_size, data) like load()
+        """
+        path = self.cache_filename(filename)
+        num_records = len(data) // record_size
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(memoryview(data)[:record_size * num_records])
+            f.write(self.TRAILER.pack(self.MAGIC, record_size, num_records))
+        size = record_size * num_records + self.TRAILER.size
+
+        with self.locked_size() as f:
+            total = self.read_size(f)
+            if total is None:
+                total = self.scan()[1]
+            try:
+                total -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            # Make room first, so the cache never exceeds the budget.
+            if total + size > self.max_bytes:
+                total = self.evict_locked(size)
+            os.replace(tmp_path, path)
+            self.write_size(f, total + size)
+        return self.load(filename) or (record_size, memoryview(data))
+
+    @contextlib.contextmanager
+    def locked_size(self):
+        """
+        Open the size file, holding an exclusive lock on it while in use.
+        """
+        fd = os.open(self.size_path, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, 'r+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield f
+
+    def read_size(self, f):
+        """
+        Total size of the cached files in the size file, None if unknown.
+        """
+        f.seek(0)
+        data = f.read(self.SIZE.size)
+        if len(data) != self.SIZE.size:
+            return None
+        return self.SIZE.unpack(data)[0]
+
+    def write_size(self, f, total):
+        f.seek(0)
+        f.write(self.SIZE.pack(total))
+        f.truncate()
+        f.flush()
+
+    def scan(self):
+        """
+        Returns (entries, total): the (mtime, size, path) of every cached
+        file, and their total size.
+        """
+        entries = []
+        total = 0
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                # Skip files still being written.
+                if not entry.name.endswith('.rec'):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        return entries, total
+
+    def evict(self):
+        """
+        Remove least recently used files until the cache is within budget.
+        """
+        with self.locked_size() as f:
+            self.write_size(f, self.evict_locked(0))
+
+    def evict_locked(self, room):
+        """
+        Remove least recently used files until room more bytes fit in the
+        budget, with the size file locked.
+
+        Returns:
+            The total size of the files left
+        """
+        entries, total = self.scan()
+        if total + room <= self.max_bytes:
+            return total
+        # Leave some headroom so we don't evict on every store.
+        target = self.max_bytes * 0.9 - room
+        entries.sort()
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        return total
+
+
+def store_chunks(cache_path, max_bytes, chunks, sizes):
+    """
+    Store chunks into a shared cache, failing if the cache is ever seen
+    over budget. Run by ChunkCacheTest in several processes at once.
+    """
+    cache = ChunkCache(cache_path, max_bytes)
+    for chunk in chunks:
+        cache.store(chunk, bytes(100 * next(sizes)), 100)
+        # Under the lock, so no other process is halfway through a store.
+        with cache.locked_size():
+            assert cache.scan()[1] <= max_bytes
+
+
+class ChunkCacheTest(unittest.TestCase):
+    def test_store_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunk = os.path.join(tmpdir, 'training.1.gz')
+            with open(chunk, 'wb') as f:
+                f.write(b'x')
+            cache = ChunkCache(os.path.join(tmpdir, 'cache'), 1 << 20)
+            assert cache.load(chunk) is None
+            record_size, data = cache.store(chunk, b'abcdefg', 3)
+            assert record_size == 3 and bytes(data) == b'abcdef'
+            record_size, data = cache.load(chunk)
+            assert record_size == 3 and bytes(data) == b'abcdef'
+
+    def test_evict(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            # Large budget while filling, so store() doesn't evict yet.
+            cache = ChunkCache(os.path.join(tmpdir, 'cache'), 1 << 20)
+            chunks = []
+            for i in range(8):
+                chunk = os.path.join(tmpdir, 'training.{}.gz'.format(i))
+                with open(chunk, 'wb') as f:
+                    f.write(b'x')
+                chunks.append(chunk)
+                cache.store(chunk, bytes(2000), 100)
+                # Make sure modification times are ordered.
+                path = cache.cache_filename(chunk)
+                os.utime(path, (time.time() + i, time.time() + i))
+            cache.max_bytes = 10000
+            cache.evict()
+            cached = [cache.load(c) is not None for c in chunks]
+            # Only the most recent ones fit in the budget.
+            assert cached == [False] * 4 + [True] * 4
+
+    def test_shared_budget(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_path = os.path.join(tmpdir, 'cache')
+            max_bytes = 50000
+            processes = []
+            for i in range(4):
+                chunks = []
+                for j in range(50):
+                    chunk = os.path.join(tmpdir,
+                                         'training.{}.gz'.format(i * 50 + j))
+                    with open(chunk, 'wb') as f:
+                        f.write(b'x')
+                    chunks.append(chunk)
+                sizes = iter(range(10, 60))
+                p = mp.Process(target=store_chunks,
+                               args=(cache_path, max_bytes, chunks, sizes))
+                p.start()
+                processes.append(p)
+            for p in processes:
+                p.join()
+                assert p.exitcode == 0
+            cache = ChunkCache(cache_path, max_bytes)
+            total = cache.scan()[1]
+            assert 0 < total <= max_bytes
+            with cache.locked_size() as f:
+                assert cache.read_size(f) == total
+
+
+if __name__ == '__main__':
+    unittest.main()
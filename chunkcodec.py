@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+#
+# Decompression of training chunk files
+# Detects the chunk codec from its magic bytes, and uses the fastest
+# installed implementation for it.
+
+import collections
+import gzip
+import mmap
+import os
+import tempfile
+import unittest
+import zlib
+
+try:
+    from isal import igzip
+except ImportError:
+    # Fall back to zlib for gzip chunks.
+    igzip = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+LZ4_MAGIC = b'\x04\x22\x4d\x18'
+
+
+def zlib_gunzip(data):
+    """
+    Decompress gzip data with zlib, including files of several gzip
+    members like gzip.open reads.
+    """
+    out = []
+    while data:
+        d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        out.append(d.decompress(data))
+        if not d.eof:
+            raise EOFError("Compressed file ended before the "
+                           "end-of-stream marker was reached")
+        # Trailing zero padding is allowed after the last member.
+        data = d.unused_data.lstrip(b'\x00')
+    return b''.join(out)
+
+
+def gunzip(data):
+    if igzip is not None:
+        return igzip.decompress(data)
+    return zlib_gunzip(data)
+
+
+def gzip_compress(data):
+    if igzip is not None:
+        return igzip.compress(data)
+    return gzip.compress(data)
+
+
+def zstd_decompress(data):
+    if zstandard is None:
+        raise ValueError("zstd chunks require the zstandard package")
+    # A decompressobj also handles frames without a content size.
+    return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+def zstd_compress(data):
+    if zstandard is None:
+        raise ValueError("zstd chunks require the zstandard package")
+    return zstandard.ZstdCompressor().compress(data)
+
+
+def lz4_decompress(data):
+    if lz4frame is None:
+        raise ValueError("lz4 chunks require the lz4 package")
+    return lz4frame.decompress(data)
+
+
+def lz4_compress(data):
+    if lz4frame is None:
+        raise ValueError("lz4 chunks require the lz4 package")
+    return lz4frame.compress(data)
+
+
+Codec = collections.namedtuple('Codec', ['magic', 'decompress', 'compress'])
+
+# Raw must come last, its empty magic matches anything.
+CODECS = collections.OrderedDict([
+    ('gzip', Codec(GZIP_MAGIC, gunzip, gzip_compress)),
+    ('zstd', Codec(ZSTD_MAGIC, zstd_decompress, zstd_compress)),
+    ('lz4', Codec(LZ4_MAGIC, lz4_decompress, lz4_compress)),
+    ('raw', Codec(b'', bytes, bytes)),
+])
+
+
+def available_codecs():
+    """
+    Names of the codecs usable with the installed packages.
+    """
+    missing = set()
+    if zstandard is None:
+        missing.add('zstd')
+    if lz4frame is None:
+        missing.add('lz4')
+    return [name for name in CODECS if name not in missing]
+
+
+def detect_codec(data):
+    """
+    Name of the codec of chunk data, from its first bytes. Anything
+    without a known magic is taken to be uncompressed records.
+    """
+    for name, codec in CODECS.items():
+        if data.startswith(codec.magic):
+            return name
+
+
+def decompress(data):
+    return CODECS[detect_codec(data)].decompress(data)
+
+
+def read_chunk(filename):
+    """
+    Read and decompress a whole chunk file. Chunks are small, so one read
+    into memory followed by one decompress call is much cheaper than
+    streaming through gzip.open in small blocks.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    return decompress(data)
+
+
+def map_chunk(filename):
+    """
+    Like read_chunk, but uncompressed chunks are memory mapped rather than
+    read, so only the pages of the records actually used are read.
+
+    Returns:
+        (data, mapped) where mapped tells if data is a read only memoryview
+        of an mmap of the file.
+    """
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+        if detect_codec(magic) != 'raw' or len(magic) < 4:
+            return decompress(magic + f.read()), False
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mm), True
+
+
+class ChunkCodecTest(unittest.TestCase):
+    def test_gzip(self):
+        data = bytes(range(256)) * 100
+        compressed = gzip.compress(data[:1000]) + gzip.compress(data[1000:])
+        self.assertEqual(detect_codec(compressed), 'gzip')
+        self.assertEqual(decompress(compressed), data)
+        self.assertEqual(zlib_gunzip(compressed), data)
+        with self.assertRaises(EOFError):
+            zlib_gunzip(compressed[:-10])
+
+    def test_round_trip(self):
+        data = b'\x05\x00\x00\x00' + bytes(range(256)) * 100
+        self.assertEqual(detect_codec(data), 'raw')
+        for name in available_codecs():
+            compressed = CODECS[name].compress(data)
+            self.assertEqual(detect_codec(compressed), name)
+            self.assertEqual(decompress(compressed), data)
+
+    def test_map_chunk(self):
+        data = b'\x05\x00\x00\x00' + bytes(range(256)) * 100
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'training.1')
+            with open(filename, 'wb') as f:
+                f.write(data)
+            mapped = map_chunk(filename)
+            self.assertTrue(mapped[1])
+            self.assertEqual(bytes(mapped[0]), data)
+            with open(filename, 'wb') as f:
+                f.write(gzip.compress(data))
+            self.assertEqual(map_chunk(filename), (data, False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,16 +17,24 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Leela Chess.  If not, see <http://www.gnu.org/licenses/>.
 
+import chunkcache as cc
+import chunkcodec
+import chunkshard as cs
+import collections
 import itertools
 import multiprocessing as mp
 import numpy as np
 import random
+import ringbuffer as rb
 import shufflebuffer as sb
+import stagetimer as st
 import struct
 import tensorflow as tf
 import unittest
 import gzip
-from select import select
+import os
+import tempfile
+import time
 
 V5_VERSION = struct.pack('i', 5)
 CLASSICAL_INPUT = struct.pack('i', 1)
@@ -36,12 +44,136 @@ V5_STRUCT_STRING = '4si7432s832sBBBBBBBbfffffff'
 V4_STRUCT_STRING = '4s7432s832sBBBBBBBbffff'
 V3_STRUCT_STRING = '4s7432s832sBBBBBBBb'
 
+# numpy view of V5_STRUCT_STRING, used to decode whole batches of records at
+# once. Field order, sizes and (native) byte order match the struct exactly.
+V5_DTYPE = np.dtype([('version', 'S4'), ('input_format', 'i4'),
+                     ('probs', 'f4', (1858, )), ('planes', 'u1', (832, )),
+                     ('us_ooo', 'u1'), ('us_oo', 'u1'), ('them_ooo', 'u1'),
+                     ('them_oo', 'u1'), ('stm', 'u1'), ('rule50_count', 'u1'),
+                     ('dep_ply_count', 'u1'), ('result', 'i1'),
+                     ('root_q', 'f4'), ('best_q', 'f4'), ('root_d', 'f4'),
+                     ('best_d', 'f4'), ('root_m', 'f4'), ('best_m', 'f4'),
+                     ('plies_left', 'f4')])
+
+# Packed planes are the 832 bytes of bit planes and the 8 single byte
+# fields after them (castling, stm, rule50, ply count and result), as they
+# are in the v5 record. tfpipeline.expand_planes unpacks them.
+PACKED_PLANES_SIZE = 840
+
+# Sparse policy targets list the legal moves of a position, at most 218 in
+# any chess position, by policy index in increasing order with their
+# probabilities. Unused entries have index -1 and probability 0.
+MAX_LEGAL_MOVES = 218
+SPARSE_POLICY_DTYPE = np.dtype([('index', '<i2', (MAX_LEGAL_MOVES, )),
+                                ('prob', '<f4', (MAX_LEGAL_MOVES, ))])
+
 
 def reverse_expand_bits(plane):
     return np.unpackbits(np.array([plane], dtype=np.uint8))[::-1].astype(
         np.float32).tobytes()
 
 
+def reverse_expand_bits_batch(values):
+    """
+    Batched reverse_expand_bits: uint8 array of shape (N,) to float32 array
+    of shape (N, 8) with the bits in little endian order.
+    """
+    return np.unpackbits(values.reshape(-1, 1), axis=1)[:, ::-1].astype(
+        np.float32)
+
+
+def sparse_policy_batch(probs):
+    """
+    Convert (N, 1858) dense policy targets, -1 for illegal moves, into a
+    (N, ) SPARSE_POLICY_DTYPE array.
+    """
+    legal = probs >= 0
+    count = legal.sum(axis=1)
+    assert (count <= MAX_LEGAL_MOVES).all()
+    # Legal moves first, each group in increasing index order.
+    order = np.argsort(~legal, axis=1, kind='stable')[:, :MAX_LEGAL_MOVES]
+    used = np.arange(MAX_LEGAL_MOVES) < count.reshape(-1, 1)
+    sparse = np.empty(len(probs), dtype=SPARSE_POLICY_DTYPE)
+    sparse['index'] = np.where(used, order, -1)
+    sparse['prob'] = np.where(used, np.take_along_axis(probs, order, axis=1),
+                              0)
+    return sparse
+
+
+class CompactV5Format:
+    """
+    Compact fixed size encoding of v5 records for the shuffle buffer.
+
+    The 7432 byte probs vector is replaced by a 1858 bit legal move mask
+    (probs >= 0) and up to policy_entries (uint16 index, float16 prob)
+    pairs for the moves with probs > 0. All other fields are kept as is.
+    Records within the limit round trip exactly apart from float16
+    rounding of the probabilities. Records with more visited moves keep
+    only their largest policy_entries probabilities, rescaled to the
+    original sum.
+    """
+    PROBS_BEGIN = V5_DTYPE.fields['probs'][1]
+    PROBS_END = PROBS_BEGIN + V5_DTYPE['probs'].itemsize
+    MASK_SIZE = (1858 + 7) // 8
+    NO_ENTRY = 0xffff
+
+    def __init__(self, policy_entries=64):
+        assert 0 < policy_entries < 1858
+        self.policy_entries = policy_entries
+        self.fixed_size = V5_DTYPE.itemsize - (self.PROBS_END -
+                                               self.PROBS_BEGIN)
+        self.dtype = np.dtype([('fixed', 'u1', (self.fixed_size, )),
+                               ('mask', 'u1', (self.MASK_SIZE, )),
+                               ('index', 'u2', (policy_entries, )),
+                               ('prob', 'f2', (policy_entries, ))])
+        self.size = self.dtype.itemsize
+
+    def encode(self, records):
+        """
+        Encode a uint8 array of shape (n, v5 record size) into a uint8
+        array of shape (n, self.size).
+        """
+        records = np.asarray(records).reshape(-1, V5_DTYPE.itemsize)
+        probs = records[:, self.PROBS_BEGIN:self.PROBS_END].copy().view(
+            np.float32)
+        out = np.empty(len(records), dtype=self.dtype)
+        out['fixed'] = np.concatenate(
+            [records[:, :self.PROBS_BEGIN], records[:, self.PROBS_END:]],
+            axis=1)
+        out['mask'] = np.packbits(probs >= 0, axis=1)
+
+        k = self.policy_entries
+        index = np.argpartition(-probs, k - 1, axis=1)[:, :k]
+        prob = np.take_along_axis(probs, index, axis=1)
+        visited = prob > 0
+        # Rescale records that lost some of their visited moves.
+        total = np.where(probs > 0, probs, 0).sum(axis=1, keepdims=True)
+        kept = np.where(visited, prob, 0).sum(axis=1, keepdims=True)
+        prob = prob * np.where(kept > 0, total / np.maximum(kept, 1e-30), 1)
+        out['index'] = np.where(visited, index, self.NO_ENTRY)
+        out['prob'] = np.where(visited, prob, 0)
+        return out.view(np.uint8).reshape(len(records), self.size)
+
+    def decode(self, compact):
+        """
+        Expand a uint8 array of shape (n, self.size) back into a uint8
+        array of shape (n, v5 record size).
+        """
+        compact = np.ascontiguousarray(compact).view(self.dtype).reshape(-1)
+        n = len(compact)
+        records = np.empty((n, V5_DTYPE.itemsize), dtype=np.uint8)
+        records[:, :self.PROBS_BEGIN] = compact['fixed'][:, :self.
+                                                         PROBS_BEGIN]
+        records[:, self.PROBS_END:] = compact['fixed'][:, self.PROBS_BEGIN:]
+        legal = np.unpackbits(compact['mask'], axis=1)[:, :1858]
+        probs = legal.astype(np.float32) - 1.0
+        rows, entries = np.nonzero(compact['index'] != self.NO_ENTRY)
+        probs[rows, compact['index'][rows, entries]] = compact['prob'][
+            rows, entries]
+        records[:, self.PROBS_BEGIN:self.PROBS_END] = probs.view(np.uint8)
+        return records
+
+
 # Interface for a chunk data source.
 class ChunkDataSrc:
     def __init__(self, items):
@@ -53,32 +185,54 @@ class ChunkDataSrc:
         return self.items.pop()
 
 
-def chunk_reader(chunk_filenames, chunk_filename_queue):
+def select_chunks(chunks, rank=0, world_size=1, seed=None, epoch=0):
     """
-    Reads chunk filenames from a list and writes them in shuffled
-    order to output_pipes.
+    Returns the share of trainer rank out of world_size trainers of the
+    chunks, every world_size'th chunk, so that trainers given the same list
+    read disjoint chunks. With a seed the list is first shuffled by seed
+    and epoch, the same way in every trainer, so the shares change each
+    epoch while staying disjoint.
     """
-    chunks = []
-    done = chunk_filenames
+    chunks = list(chunks)
+    if seed is not None:
+        random.Random(seed * 1000003 + epoch).shuffle(chunks)
+    return chunks[rank::world_size]
 
-    while True:
-        if not chunks:
-            chunks, done = done, chunks
+
+def chunk_reader(chunk_filenames,
+                 chunk_filename_queue,
+                 rank=0,
+                 world_size=1,
+                 seed=None):
+    """
+    Reads chunk filenames from a list and writes them in shuffled
+    order to output_pipes. Only the share of trainer rank out of
+    world_size is written, see select_chunks(), redrawn each epoch if
+    seed is set.
+    """
+    for epoch in itertools.count():
+        chunks = select_chunks(chunk_filenames, rank, world_size, seed,
+                               epoch)
+        if seed is None:
             random.shuffle(chunks)
         if not chunks:
             print("chunk_reader didn't find any chunks.")
             return None
-        while len(chunks):
-            filename = chunks.pop()
-            done.append(filename)
+        for filename in chunks:
             chunk_filename_queue.put(filename)
-    print("chunk_reader exiting.")
-    return None
 
 
 class ChunkParser:
     # static batch size
     BATCH_SIZE = 8
+    # most items read from one worker before checking the others
+    MAX_DRAIN = 64
+    # most shard files a worker keeps open, least recently read closed first
+    MAX_OPEN_SHARDS = 64
+    # Profiled stages, each consuming the one before it. Workers also time
+    # sending their items as 'send'.
+    WORKER_STAGES = ['read', 'shuffle', 'decode']
+    PARENT_STAGES = ['receive', 'shuffle', 'decode']
 
     def __init__(self,
                  chunks,
@@ -87,7 +241,18 @@ class ChunkParser:
                  sample=1,
                  buffer_size=1,
                  batch_size=256,
-                 workers=None):
+                 workers=None,
+                 worker_decode=False,
+                 transport='pipe',
+                 compact_policy_entries=None,
+                 chunk_cache_dir=None,
+                 chunk_cache_size=0,
+                 packed_planes=False,
+                 sparse_policy=False,
+                 profile_stages=False,
+                 rank=0,
+                 world_size=1,
+                 shard_seed=None):
         """
         Read data and yield batches of raw tensors.
 
@@ -95,11 +260,35 @@ class ChunkParser:
         'shuffle_size' is the size of the shuffle buffer.
         'sample' is the rate to down-sample.
         'workers' is the number of child workers to use.
+        'worker_decode' moves shuffling and decoding into the workers. Each
+        worker then owns 1/workers of the shuffle buffer and sends complete
+        batches, so decode cost scales with the number of workers.
+        'transport' is how workers hand data to the parent: 'pipe' sends
+        every item through a multiprocessing pipe, 'shm' writes them into a
+        shared memory ring per worker that the parent reads in place.
+        'compact_policy_entries' if set, keeps records in the shuffle buffer
+        in CompactV5Format with that many policy entries, so the same memory
+        holds 5-10x more positions.
+        'chunk_cache_dir' if set, keeps decompressed copies of the chunks in
+        that directory and reads them back through mmap on later passes.
+        'chunk_cache_size' is the disk budget of the chunk cache in bytes,
+        least recently used chunks are removed beyond it.
+        'packed_planes' yields planes as PACKED_PLANES_SIZE bytes per
+        position, to be expanded by the model, instead of 112x64 floats.
+        'sparse_policy' yields policy targets as SPARSE_POLICY_DTYPE, the
+        legal moves and their probabilities, instead of 1858 floats.
+        'profile_stages' times the stages of the workers and the parent,
+        see stage_stats().
+        'rank' and 'world_size' make this parser read only its share of the
+        chunks when world_size trainers read the same list, see
+        select_chunks(). 'shard_seed' shared by all trainers redraws the
+        shares every epoch, otherwise each keeps the same share.
 
         The data is represented in a number of formats through this dataflow
         pipeline. In order, they are:
 
-        chunk: The name of a file containing chunkdata
+        chunk: The name of a file containing chunkdata, or a (shard, begin,
+        end) triple naming a run of blocks in a chunkshard file
 
         chunkdata: type Bytes. Multiple records of v5 format where each record
         consists of (state, policy, result, q)
@@ -130,24 +319,82 @@ class ChunkParser:
 
         print("Using {} worker processes.".format(workers))
 
+        self.worker_decode = worker_decode
+        self.packed_planes = packed_planes
+        self.sparse_policy = sparse_policy
+        self.compact_policy_entries = compact_policy_entries
+        self.worker_shuffle_size = max(1, shuffle_size // workers)
+        # Byte sizes of the raw tensors in a decoded batch, from a probe
+        # record with no legal moves.
+        record = np.zeros(1, dtype=V5_DTYPE)
+        record['input_format'] = expected_input_format
+        record['probs'] = -1
+        self.batch_part_sizes = [
+            x.nbytes * batch_size
+            for x in self.convert_v5_batch(record.tobytes())
+        ]
+
+        # Stage timers of the parent and, in shared memory, of each worker.
+        self.parent_timer = None
+        self.worker_timers = [None] * workers
+        if profile_stages:
+            self.parent_timer = st.StageTimer(self.PARENT_STAGES)
+            self.worker_timers = [
+                st.StageTimer(self.WORKER_STAGES,
+                              direct=['send'],
+                              shared=True) for _ in range(workers)
+            ]
+        self.stage_totals = {}
+
+        # Open readers of the shards read last, filled in by the workers.
+        self.shards = collections.OrderedDict()
+        self.chunk_cache = None
+        if chunk_cache_dir is not None:
+            self.chunk_cache = cc.ChunkCache(chunk_cache_dir, chunk_cache_size)
+
+        if transport not in ('pipe', 'shm'):
+            raise ValueError("Unknown transport: {}".format(transport))
+        self.transport = transport
+
         # Start the child workers running
         self.readers = []
         self.writers = []
         self.processes = []
         self.chunk_filename_queue = mp.Queue(maxsize=4096)
-        for _ in range(workers):
-            read, write = mp.Pipe(duplex=False)
+        # Released for every item put in any ring, see ring_gen().
+        self.ring_ready = mp.Semaphore(0)
+        for worker in range(workers):
+            if transport == 'shm':
+                if worker_decode:
+                    ring = rb.SharedRingBuffer(sum(self.batch_part_sizes),
+                                               2,
+                                               ready=self.ring_ready)
+                else:
+                    ring = rb.SharedRingBuffer(
+                        struct.calcsize(V5_STRUCT_STRING),
+                        256,
+                        ready=self.ring_ready)
+                read, write = ring, ring
+            else:
+                read, write = mp.Pipe(duplex=False)
             p = mp.Process(target=self.task,
-                           args=(self.chunk_filename_queue, write))
+                           args=(self.chunk_filename_queue, write,
+                                 self.worker_timers[worker]))
             p.daemon = True
             self.processes.append(p)
             p.start()
             self.readers.append(read)
             self.writers.append(write)
 
+        # Items received from each worker, for worker_throughput().
+        self.worker_items = [0] * workers
+        self.throughput_items = [0] * workers
+        self.throughput_time = time.time()
+
         self.chunk_process = mp.Process(target=chunk_reader,
                                         args=(chunks,
-                                              self.chunk_filename_queue))
+                                              self.chunk_filename_queue,
+                                              rank, world_size, shard_seed))
         self.chunk_process.daemon = True
         self.chunk_process.start()
 
@@ -161,7 +408,8 @@ class ChunkParser:
             self.processes[i].terminate()
             self.processes[i].join()
             self.readers[i].close()
-            self.writers[i].close()
+            if self.transport == 'pipe':
+                self.writers[i].close()
         self.chunk_process.terminate()
         self.chunk_process.join()
 
@@ -175,18 +423,45 @@ class ChunkParser:
         self.v3_struct = struct.Struct(V3_STRUCT_STRING)
 
     @staticmethod
-    def parse_function(planes, probs, winner, q, plies_left):
+    def parse_function(planes,
+                       probs,
+                       winner,
+                       q,
+                       plies_left,
+                       packed_planes=False,
+                       sparse_policy=False):
         """
         Convert unpacked record batches to tensors for tensorflow training
+
+        With sparse_policy, probs becomes an (indices, probs) pair of
+        (BATCH_SIZE, MAX_LEGAL_MOVES) int32 and float32 tensors.
         """
-        planes = tf.io.decode_raw(planes, tf.float32)
-        probs = tf.io.decode_raw(probs, tf.float32)
+        if packed_planes:
+            planes = tf.io.decode_raw(planes, tf.uint8)
+            planes = tf.reshape(planes,
+                                (ChunkParser.BATCH_SIZE, PACKED_PLANES_SIZE))
+        else:
+            planes = tf.io.decode_raw(planes, tf.float32)
+            planes = tf.reshape(planes, (ChunkParser.BATCH_SIZE, 112, 8 * 8))
+        if sparse_policy:
+            probs = tf.reshape(tf.io.decode_raw(probs, tf.uint8),
+                               (ChunkParser.BATCH_SIZE, -1))
+            indices = tf.bitcast(
+                tf.reshape(probs[:, :2 * MAX_LEGAL_MOVES],
+                           (ChunkParser.BATCH_SIZE, MAX_LEGAL_MOVES, 2)),
+                tf.int16)
+            probs = tf.bitcast(
+                tf.reshape(probs[:, 2 * MAX_LEGAL_MOVES:],
+                           (ChunkParser.BATCH_SIZE, MAX_LEGAL_MOVES, 4)),
+                tf.float32)
+            probs = (tf.cast(indices, tf.int32), probs)
+        else:
+            probs = tf.io.decode_raw(probs, tf.float32)
+            probs = tf.reshape(probs, (ChunkParser.BATCH_SIZE, 1858))
         winner = tf.io.decode_raw(winner, tf.float32)
         q = tf.io.decode_raw(q, tf.float32)
         plies_left = tf.io.decode_raw(plies_left, tf.float32)
 
-        planes = tf.reshape(planes, (ChunkParser.BATCH_SIZE, 112, 8 * 8))
-        probs = tf.reshape(probs, (ChunkParser.BATCH_SIZE, 1858))
         winner = tf.reshape(winner, (ChunkParser.BATCH_SIZE, 3))
         q = tf.reshape(q, (ChunkParser.BATCH_SIZE, 3))
         plies_left = tf.reshape(plies_left, (ChunkParser.BATCH_SIZE, ))
@@ -290,123 +565,463 @@ class ChunkParser:
 
         return (planes, probs, winner, best_q, plies_left)
 
+    @staticmethod
+    def sample_indices(num_records, sample):
+        """
+        Sorted indices of the records kept when down-sampling num_records
+        records, each kept with probability 1/sample. The gaps between kept
+        records are drawn directly, rather than a coin flip per record.
+        """
+        p = 1.0 / sample
+        indices = np.cumsum(
+            np.random.geometric(p, size=num_records // sample + 16)) - 1
+        while indices[-1] < num_records:
+            gaps = np.random.geometric(p, size=num_records // sample + 16)
+            indices = np.concatenate([indices, indices[-1] + np.cumsum(gaps)])
+        return indices[indices < num_records]
+
     def sample_record(self, chunkdata):
         """
         Randomly sample through the v3/4/5 chunk data and select records in v5 format
+
+        chunkdata can be any bytes-like object, such as an mmap view. Only
+        the records selected are copied out of it.
+        """
+        version = bytes(chunkdata[0:4])
+        record_size = self.record_size(version)
+        if record_size is None:
+            return
+
+        num_records = len(chunkdata) // record_size
+        if self.sample > 1:
+            # Downsample, using only 1/Nth of the items.
+            indices = self.sample_indices(num_records, self.sample).tolist()
+        else:
+            indices = range(num_records)
+        for i in indices:
+            record = bytes(chunkdata[i * record_size:(i + 1) * record_size])
+            yield self.upgrade_record(record, version)
+
+    @staticmethod
+    def upgrade_record(record, version):
+        """
+        Convert a v3/4 record to v5 format, v5 records are returned as is.
+        """
+        if version == V3_VERSION:
+            # add 16 bytes of fake root_q, best_q, root_d, best_d to match V4 format
+            record += 16 * b'\x00'
+        if version == V3_VERSION or version == V4_VERSION:
+            # add 12 bytes of fake root_m, best_m, plies_left to match V5 format
+            record += 12 * b'\x00'
+            # insert 4 bytes of classical input format tag to match v5 format
+            record = record[:4] + CLASSICAL_INPUT + record[4:]
+        return record
+
+    def shard_records(self, filename, begin, end):
+        """
+        Yield the records of blocks [begin, end) of a shard in v5 format.
+        With sample > 1 the records are picked up front, so only the blocks
+        holding a picked record are read and decompressed.
+        """
+        shard = self.shards.pop(filename, None)
+        if shard is None:
+            shard = cs.ShardReader(filename)
+        self.shards[filename] = shard
+        if len(self.shards) > self.MAX_OPEN_SHARDS:
+            self.shards.popitem(last=False)[1].close()
+        first = int(shard.blocks['first_record'][begin])
+        last = int(shard.blocks['first_record'][end - 1] +
+                   shard.blocks['num_records'][end - 1])
+        if self.sample > 1:
+            indices = first + self.sample_indices(last - first, self.sample)
+        else:
+            indices = np.arange(first, last)
+        for record in shard.read_records(indices):
+            yield self.upgrade_record(record, record[0:4])
+
+    def record_size(self, version):
+        """
+        Size in bytes of a record of the given version, None if unknown.
         """
-        version = chunkdata[0:4]
         if version == V5_VERSION:
-            record_size = self.v5_struct.size
+            return self.v5_struct.size
         elif version == V4_VERSION:
-            record_size = self.v4_struct.size
+            return self.v4_struct.size
         elif version == V3_VERSION:
-            record_size = self.v3_struct.size
-        else:
-            return
+            return self.v3_struct.size
+        return None
 
-        for i in range(0, len(chunkdata), record_size):
-            if self.sample > 1:
-                # Downsample, using only 1/Nth of the items.
-                if random.randint(0, self.sample - 1) != 0:
-                    continue  # Skip this record.
-            record = chunkdata[i:i + record_size]
-            if version == V3_VERSION:
-                # add 16 bytes of fake root_q, best_q, root_d, best_d to match V4 format
-                record += 16 * b'\x00'
-            if version == V3_VERSION or version == V4_VERSION:
-                # add 12 bytes of fake root_m, best_m, plies_left to match V5 format
-                record += 12 * b'\x00'
-                # insert 4 bytes of classical input format tag to match v5 format
-                record = record[:4] + CLASSICAL_INPUT + record[4:]
-            yield record
-
-    def task(self, chunk_filename_queue, writer):
+    def read_chunk(self, filename):
         """
-        Run in fork'ed process, read data from chunkdatasrc, parsing, shuffling and
-        sending v5 data through pipe back to main process.
+        Returns the decompressed contents of a chunk file as a bytes-like
+        object, or None if its version is unknown. With a chunk cache, the
+        first read of a chunk adds it to the cache and later reads come
+        from its mmap. Uncompressed chunks are always read through mmap.
+        """
+        if self.chunk_cache is not None:
+            cached = self.chunk_cache.load(filename)
+            if cached is not None:
+                return cached[1]
+        chunkdata, mapped = chunkcodec.map_chunk(filename)
+        version = bytes(chunkdata[0:4])
+        record_size = self.record_size(version)
+        if record_size is None:
+            print('Unknown version {} in file {}'.format(version, filename))
+            return None
+        if self.chunk_cache is not None and not mapped:
+            chunkdata = self.chunk_cache.store(filename, chunkdata,
+                                               record_size)[1]
+        return chunkdata
+
+    def chunk_gen(self, chunk_filename_queue):
+        """
+        Read chunk filenames from the queue and yield sampled records
+        from them in v5 format.
         """
-        self.init_structs()
         while True:
             filename = chunk_filename_queue.get()
             try:
-                with gzip.open(filename, 'rb') as chunk_file:
-                    version = chunk_file.read(4)
-                    chunk_file.seek(0)
-                    if version == V5_VERSION:
-                        record_size = self.v5_struct.size
-                    elif version == V4_VERSION:
-                        record_size = self.v4_struct.size
-                    elif version == V3_VERSION:
-                        record_size = self.v3_struct.size
-                    else:
-                        print('Unknown version {} in file {}'.format(
-                            version, filename))
-                        continue
-                    while True:
-                        chunkdata = chunk_file.read(256 * record_size)
-                        if len(chunkdata) == 0:
-                            break
-                        for item in self.sample_record(chunkdata):
-                            writer.send_bytes(item)
+                if isinstance(filename, tuple):
+                    for item in self.shard_records(*filename):
+                        yield item
+                    continue
+                chunkdata = self.read_chunk(filename)
+                if chunkdata is None:
+                    continue
+                for item in self.sample_record(chunkdata):
+                    yield item
 
             except Exception as e:
                 print(f"failed to parse {filename}: {e}")
                 continue
 
-    def v5_gen(self):
+    def task(self, chunk_filename_queue, writer, timer=None):
         """
-        Read v5 records from child workers, shuffle, and yield
-        records.
+        Run in fork'ed process, read data from chunkdatasrc, parsing, shuffling and
+        sending v5 data through pipe back to main process.
+
+        With worker_decode the worker also shuffles and decodes the records
+        itself, and sends each finished batch as its 5 raw tensors. With a
+        StageTimer, the worker's stages are timed into it.
+        """
+        self.init_structs()
+        # Forked workers inherit the numpy random state, unlike random's.
+        np.random.seed()
+        gen = self.time_stage(self.chunk_gen(chunk_filename_queue), 'read',
+                              timer)
+        if self.worker_decode:
+            gen = self.time_stage(
+                self.shuffle_gen(gen, self.worker_shuffle_size), 'shuffle',
+                timer)
+            gen = self.time_stage(self.batch_gen(gen), 'decode', timer)
+        for item in gen:
+            if not self.worker_decode:
+                item = (item, )
+            start = time.perf_counter()
+            if self.transport == 'shm':
+                writer.put(*item)
+            else:
+                for part in item:
+                    writer.send_bytes(part)
+            if timer is not None:
+                timer.add('send', time.perf_counter() - start)
+
+    def reader_gen(self, items=1):
         """
-        sbuff = sb.ShuffleBuffer(self.v5_struct.size, self.shuffle_size)
-        while len(self.readers):
-            #for r in mp.connection.wait(self.readers):
-            for r in self.readers:
+        Read items from child workers as they become ready. Up to
+        MAX_DRAIN items already waiting in a worker's pipe are read in one
+        go. With items > 1, yield tuples of that many consecutive items
+        from the same worker.
+        """
+        readers = list(self.readers)
+        while len(readers):
+            for r in mp.connection.wait(readers):
+                worker = self.readers.index(r)
                 try:
-                    s = r.recv_bytes()
-                    s = sbuff.insert_or_replace(s)
-                    if s is None:
-                        continue  # shuffle buffer not yet full
-                    yield s
+                    for _ in range(self.MAX_DRAIN):
+                        if items == 1:
+                            item = r.recv_bytes()
+                        else:
+                            item = tuple(r.recv_bytes() for _ in range(items))
+                        self.worker_items[worker] += 1
+                        yield item
+                        if not r.poll():
+                            break
                 except EOFError:
                     print("Reader EOF")
-                    self.readers.remove(r)
+                    readers.remove(r)
+
+    def ring_gen(self, items=1):
+        """
+        Read items from the workers' shared memory rings as they become
+        ready, blocking while all of them are empty, up to MAX_DRAIN from a
+        ring at a time. Items are views into
+        the ring, only valid until the next one is requested. With
+        items > 1, each slot holds that many raw tensors of a decoded batch,
+        which are yielded as a tuple of bytes.
+        """
+        offsets = np.cumsum([0] + self.batch_part_sizes)
+        worker = 0
+        while True:
+            # Every put releases ring_ready once, after the item is in its
+            # ring. Taking one release per item read keeps the two counts in
+            # step, so once ring_ready is acquired some ring holds an item.
+            self.ring_ready.acquire()
+            for _ in range(len(self.readers)):
+                worker = (worker + 1) % len(self.readers)
+                view = self.readers[worker].get(timeout=0)
+                if view is not None:
+                    break
+            ring = self.readers[worker]
+            for drained in range(self.MAX_DRAIN):
+                if drained:
+                    view = ring.get(timeout=0)
+                    if view is None:
+                        break
+                    self.ring_ready.acquire()
+                self.worker_items[worker] += 1
+                if items == 1:
+                    yield view
+                else:
+                    yield tuple(view[begin:end].tobytes()
+                                for begin, end in zip(offsets, offsets[1:]))
+                ring.release()
+
+    def worker_throughput(self):
+        """
+        Items per second received from each worker since the last call,
+        records or with worker_decode batches. Workers well below the
+        others are stragglers.
+        """
+        now = time.time()
+        elapsed = max(now - self.throughput_time, 1e-9)
+        throughput = [(items - last) / elapsed for items, last in zip(
+            self.worker_items, self.throughput_items)]
+        self.throughput_items = list(self.worker_items)
+        self.throughput_time = now
+        return throughput
+
+    def time_stage(self, gen, stage, timer=None):
+        """
+        Time gen as stage with timer, the parent's timer by default, if
+        stages are profiled.
+        """
+        timer = timer or self.parent_timer
+        if timer is None:
+            return gen
+        return timer.wrap(gen, stage)
+
+    def stage_stats(self, per_worker=False):
+        """
+        Seconds spent in and items out of each stage since the last call,
+        as {name: (seconds, items)}. Names are 'parent/<stage>' and
+        'worker/<stage>', summed over the workers, or with per_worker
+        'worker<i>/<stage>' for each worker. Items are records for 'read'
+        and, without worker_decode, 'receive'; arrays of records for
+        'shuffle'; and batches otherwise. Empty unless profile_stages.
+        """
+        if self.parent_timer is None:
+            return {}
+        totals = {
+            'parent/' + stage: value
+            for stage, value in self.parent_timer.totals().items()
+        }
+        for worker, timer in enumerate(self.worker_timers):
+            for stage, value in timer.totals().items():
+                totals['worker{}/{}'.format(worker, stage)] = value
+        stats = {}
+        for name, (seconds, items) in totals.items():
+            last_seconds, last_items = self.stage_totals.get(name, (0, 0))
+            if not per_worker and name.startswith('worker'):
+                name = 'worker/' + name.split('/')[1]
+            total_seconds, total_items = stats.get(name, (0, 0))
+            stats[name] = (total_seconds + seconds - last_seconds,
+                           total_items + items - last_items)
+        self.stage_totals = totals
+        return stats
+
+    def shuffle_gen(self, gen, shuffle_size):
+        """
+        Shuffle v5 records from gen through a shuffle buffer of
+        shuffle_size records. Records are moved in and out of the buffer
+        up to batch_size at a time, and yielded as uint8 arrays of shape
+        (n, record_size).
+        """
+        record_size = self.v5_struct.size
+        if self.compact_policy_entries:
+            compact = CompactV5Format(self.compact_policy_entries)
+            encode, decode = compact.encode, compact.decode
+            sbuff = sb.ShuffleBuffer(compact.size, shuffle_size)
+        else:
+            encode = decode = lambda x: x
+            sbuff = sb.ShuffleBuffer(record_size, shuffle_size)
+        block = np.empty((self.batch_size, record_size), dtype=np.uint8)
+        n = 0
+        for s in gen:
+            block[n] = np.frombuffer(s, dtype=np.uint8)
+            n += 1
+            if n < len(block):
+                continue
+            n = 0
+            s = sbuff.insert_or_replace_batch(encode(block))
+            if not len(s):
+                continue  # shuffle buffer not yet full
+            yield decode(s)
+        s = sbuff.insert_or_replace_batch(encode(block[:n]))
+        if len(s):
+            yield decode(s)
         # drain the shuffle buffer.
         while True:
-            s = sbuff.extract()
-            if s is None:
+            s = sbuff.extract_batch(self.batch_size)
+            if not len(s):
                 return
-            yield s
+            yield decode(s)
+
+    def v5_gen(self):
+        """
+        Read v5 records from child workers, shuffle, and yield
+        records.
+        """
+        if self.transport == 'shm':
+            gen = self.ring_gen()
+        else:
+            gen = self.reader_gen()
+        gen = self.time_stage(gen, 'receive')
+        return self.time_stage(self.shuffle_gen(gen, self.shuffle_size),
+                               'shuffle')
+
+    def worker_batch_gen(self):
+        """
+        Read batches that were already decoded by the child workers.
+        """
+        if self.transport == 'shm':
+            gen = self.ring_gen(items=5)
+        else:
+            gen = self.reader_gen(items=5)
+        return self.time_stage(gen, 'receive')
 
-    def tuple_gen(self, gen):
+    def convert_v5_batch(self, content):
         """
-        Take a generator producing v5 records and convert them to tuples.
-        applying a random symmetry on the way.
+        Unpack N concatenated v5 records into batched numpy arrays
+        (planes, probs, winner, q, plies_left) with shapes (N, 112, 64),
+        (N, 1858), (N, 3), (N, 3) and (N, ).
+
+        This is the vectorized equivalent of calling convert_v5_to_tuple on
+        each record; the results are bit identical. With packed_planes,
+        planes are (N, PACKED_PLANES_SIZE) uint8 instead, and with
+        sparse_policy probs are (N, ) SPARSE_POLICY_DTYPE.
         """
-        for r in gen:
-            yield self.convert_v5_to_tuple(r)
+        records = np.frombuffer(content, dtype=V5_DTYPE)
+        n = len(records)
+        assert (records['input_format'] == self.expected_input_format).all()
+
+        if self.packed_planes:
+            offset = V5_DTYPE.fields['planes'][1]
+            planes = records.view(np.uint8).reshape(
+                n, -1)[:, offset:offset + PACKED_PLANES_SIZE]
+        else:
+            planes = self.expand_planes(records)
+
+        winner = records['result']
+        assert np.isin(winner, [-1, 0, 1]).all()
+        winner = np.stack([winner == 1, winner == 0, winner == -1],
+                          axis=1).astype(np.float32)
+
+        best_q = records['best_q'].astype(np.float64)
+        best_d = records['best_d'].astype(np.float64)
+        assert ((-1.0 <= best_q) & (best_q <= 1.0) & (0.0 <= best_d) &
+                (best_d <= 1.0)).all()
+        q = np.stack([
+            0.5 * (1.0 - best_d + best_q), best_d,
+            0.5 * (1.0 - best_d - best_q)
+        ],
+                     axis=1).astype(np.float32)
+
+        # v3/4 data sometimes has a useful value in dep_ply_count, so copy
+        # that over if the new ply_count is not populated.
+        plies_left = records['plies_left']
+        plies_left = np.where(plies_left == 0, records['dep_ply_count'],
+                              plies_left).astype(np.float32)
+
+        probs = records['probs']
+        if self.sparse_policy:
+            probs = sparse_policy_batch(probs)
+
+        return (planes, probs, winner, q, plies_left)
+
+    def expand_planes(self, records):
+        """
+        Unpack the input planes of a V5_DTYPE array of records into a
+        (N, 112, 64) float32 array.
+        """
+        n = len(records)
+        input_format = self.expected_input_format
+        planes = np.zeros((n, 112, 64), dtype=np.float32)
+        # Unpack bit planes and cast to 32 bit float
+        planes[:, :104] = np.unpackbits(records['planes'], axis=1).reshape(
+            n, 104, 64)
+
+        if input_format == 1:
+            for i, field in enumerate(
+                ['us_ooo', 'us_oo', 'them_ooo', 'them_oo', 'stm']):
+                planes[:, 104 + i] = records[field].reshape(-1, 1)
+        else:
+            # Each inner array has to be reversed as these fields are in
+            # opposite endian to the planes data.
+            planes[:, 104, :8] = reverse_expand_bits_batch(records['us_ooo'])
+            planes[:, 104, 56:] = reverse_expand_bits_batch(
+                records['them_ooo'])
+            planes[:, 105, :8] = reverse_expand_bits_batch(records['us_oo'])
+            planes[:, 105, 56:] = reverse_expand_bits_batch(
+                records['them_oo'])
+            if input_format == 2:
+                planes[:, 108] = records['stm'].reshape(-1, 1)
+            else:
+                planes[:, 108,
+                       56:] = reverse_expand_bits_batch(records['stm'])
+
+        rule50_divisor = 99.0
+        if input_format > 3:
+            rule50_divisor = 100.0
+        planes[:, 109] = (records['rule50_count'] /
+                          rule50_divisor).reshape(-1, 1)
+        if input_format == 132 or input_format == 133:
+            planes[:, 110] = (records['dep_ply_count'] >= 128).reshape(-1, 1)
+        # Make the last plane all 1's so the NN can detect edges of the board
+        # more easily
+        planes[:, 111] = 1.0
+        return planes
 
     def batch_gen(self, gen):
         """
-        Pack multiple records into a single batch
+        Regroup arrays of v5 records into batches of batch_size records and
+        decode each batch in one go.
         """
-        # Get N records. We flatten the returned generator to
-        # a list because we need to reuse it.
-        while True:
-            s = list(itertools.islice(gen, self.batch_size))
-            if not len(s):
-                return
-            yield (b''.join([x[0] for x in s]), b''.join([x[1] for x in s]),
-                   b''.join([x[2] for x in s]), b''.join([x[3] for x in s]),
-                   b''.join([x[4] for x in s]))
+        pending = []
+        count = 0
+        for s in gen:
+            pending.append(s)
+            count += len(s)
+            while count >= self.batch_size:
+                s = np.concatenate(pending) if len(pending) > 1 else pending[0]
+                batch, s = s[:self.batch_size], s[self.batch_size:]
+                yield tuple(x.tobytes() for x in self.convert_v5_batch(batch))
+                pending = [s] if len(s) else []
+                count = len(s)
+        if count:
+            s = np.concatenate(pending)
+            yield tuple(x.tobytes() for x in self.convert_v5_batch(s))
 
     def parse(self):
         """
         Read data from child workers and yield batches of unpacked records
         """
-        gen = self.v5_gen()  # read from workers
-        gen = self.tuple_gen(gen)  # convert v5->tuple
-        gen = self.batch_gen(gen)  # assemble into batches
+        if self.worker_decode:
+            gen = self.worker_batch_gen()  # read decoded batches from workers
+        else:
+            gen = self.v5_gen()  # read from workers
+            # assemble and convert batches v5->tuple
+            gen = self.time_stage(self.batch_gen(gen), 'decode')
         for b in gen:
             yield b
 
@@ -454,11 +1069,349 @@ class ChunkParserTest(unittest.TestCase):
                                    i[4], i[5], i[6], winner, root_q, best_q,
                                    root_d, best_d)
 
+    def v5_record(self, input_format, planes, i, probs, winner, best_q,
+                  best_d):
+        pl = np.packbits(np.array(planes, dtype=np.uint8)).tobytes()
+        pi = probs.astype(np.float32).tobytes()
+        root_q, root_d, root_m, best_m = 0.0, 0.0, 0.0, 0.0
+        plies_left = float(np.random.randint(2)) * 10.0
+        return struct.pack(V5_STRUCT_STRING, V5_VERSION, input_format, pi, pl,
+                           i[0], i[1], i[2], i[3], i[4], i[5], i[6], winner,
+                           root_q, best_q, root_d, best_d, root_m, best_m,
+                           plies_left)
+
     def test_structsize(self):
         """
         Test struct size
         """
         self.assertEqual(self.v4_struct.size, 8292)
+        self.assertEqual(V5_DTYPE.itemsize, struct.calcsize(V5_STRUCT_STRING))
+
+    def test_batch_decode(self):
+        """
+        Test that batched decoding matches decoding record by record.
+        """
+        parser = ChunkParser([], 1, workers=1)
+        for input_format in [1, 2, 3, 4, 5, 132, 133]:
+            parser.expected_input_format = input_format
+            records = []
+            for _ in range(6):
+                planes, integer, probs, winner, best_q, best_d = \
+                    self.generate_fake_pos()
+                if input_format != 1:
+                    # Castling fields are full bytes here.
+                    integer[:4] = np.random.randint(256, size=4)
+                if input_format > 2:
+                    # So is the en passant field which replaces stm.
+                    integer[4] = np.random.randint(256)
+                integer[6] = np.random.randint(256)
+                records.append(
+                    self.v5_record(input_format, planes, integer, probs,
+                                   winner, best_q, best_d))
+            batch = parser.convert_v5_batch(b''.join(records))
+            for i, record in enumerate(records):
+                truth = parser.convert_v5_to_tuple(record)
+                for x, y in zip(batch, truth):
+                    self.assertEqual(x[i].tobytes(), y)
+        parser.shutdown()
+
+    def write_v5_chunks(self, tmpdir, num_chunks, records_per_chunk):
+        """
+        Write gzipped v5 chunks of identical fake records to tmpdir.
+        """
+        truth = self.generate_fake_pos()
+        record = self.v5_record(1, *truth)
+        chunks = []
+        for i in range(num_chunks):
+            filename = os.path.join(tmpdir, 'training.{}.gz'.format(i))
+            with gzip.open(filename, 'wb') as f:
+                f.write(record * records_per_chunk)
+            chunks.append(filename)
+        return chunks, record
+
+    def test_compact_format(self):
+        """
+        Test the compact shuffle buffer encoding round trip.
+        """
+        fmt = CompactV5Format(policy_entries=8)
+        self.assertLess(fmt.size * 6, V5_DTYPE.itemsize)
+        records = []
+        for i in range(5):
+            planes, integer, _, winner, best_q, best_d = \
+                self.generate_fake_pos()
+            probs = -np.ones(1858, dtype=np.float32)
+            legal = np.random.choice(1858, 30, replace=False)
+            probs[legal] = 0
+            # Values exactly representable as float16.
+            visits = np.random.randint(1, 64, size=i + 4)
+            probs[legal[:i + 4]] = visits / 64
+            records.append(
+                self.v5_record(1, planes, integer, probs, winner, best_q,
+                               best_d))
+        records = np.frombuffer(b''.join(records), dtype=np.uint8).reshape(
+            5, -1)
+        out = fmt.decode(fmt.encode(records))
+        # Records with up to 8 visited moves come back unchanged.
+        self.assertTrue((out[:5 - 1] == records[:5 - 1]).all())
+        # The last one had 9, the smallest is dropped but the sum is kept.
+        probs = out[-1].view(V5_DTYPE)['probs'][0]
+        truth = records[-1].view(V5_DTYPE)['probs'][0]
+        self.assertTrue(((probs >= 0) == (truth >= 0)).all())
+        self.assertEqual((probs > 0).sum(), 8)
+        self.assertAlmostEqual(probs[probs > 0].sum(),
+                               truth[truth > 0].sum(),
+                               places=3)
+
+    def test_worker_decode(self):
+        """
+        Test that batches decoded in the workers match decoding in the
+        parent.
+        """
+        batch_size = 4
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunks, record = self.write_v5_chunks(tmpdir, 2, 3)
+            parser = ChunkParser(chunks,
+                                 1,
+                                 shuffle_size=8,
+                                 workers=2,
+                                 batch_size=batch_size,
+                                 worker_decode=True)
+            truth = [
+                x.tobytes()
+                for x in parser.convert_v5_batch(record * batch_size)
+            ]
+            batchgen = parser.parse()
+            for _ in range(4):
+                self.assertEqual(list(next(batchgen)), truth)
+            parser.shutdown()
+
+    def test_shm_transport(self):
+        """
+        Test reading records and decoded batches through shared memory.
+        """
+        batch_size = 4
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunks, record = self.write_v5_chunks(tmpdir, 2, 3)
+            for worker_decode in [False, True]:
+                parser = ChunkParser(chunks,
+                                     1,
+                                     shuffle_size=8,
+                                     workers=2,
+                                     batch_size=batch_size,
+                                     worker_decode=worker_decode,
+                                     transport='shm')
+                truth = [
+                    x.tobytes()
+                    for x in parser.convert_v5_batch(record * batch_size)
+                ]
+                batchgen = parser.parse()
+                for _ in range(4):
+                    self.assertEqual(list(next(batchgen)), truth)
+                parser.shutdown()
+
+    def test_sparse_policy_parser(self):
+        """
+        Test that batches with sparse policy targets come through the
+        workers and parse_function.
+        """
+        batch_size = 4
+        planes, integer, _, winner, best_q, best_d = self.generate_fake_pos()
+        probs = -np.ones(1858, dtype=np.float32)
+        legal = np.random.choice(1858, 30, replace=False)
+        probs[legal] = np.random.random(30)
+        record = self.v5_record(1, planes, integer, probs, winner, best_q,
+                                best_d)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'training.0.gz')
+            with gzip.open(filename, 'wb') as f:
+                f.write(record * 3)
+            for worker_decode in [False, True]:
+                parser = ChunkParser([filename],
+                                     1,
+                                     workers=1,
+                                     batch_size=batch_size,
+                                     worker_decode=worker_decode,
+                                     sparse_policy=True)
+                batch = next(parser.parse())
+                parser.shutdown()
+                self.assertEqual([len(x) for x in batch],
+                                 parser.batch_part_sizes)
+                ChunkParser.BATCH_SIZE = batch_size
+                indices, values = ChunkParser.parse_function(
+                    *batch, sparse_policy=True)[1]
+                dense = np.zeros((batch_size, 1858), dtype=np.float32)
+                for i in range(batch_size):
+                    used = indices[i].numpy() >= 0
+                    dense[i, indices[i].numpy()[used]] = values[i].numpy(
+                    )[used]
+                self.assertTrue((dense == np.maximum(probs, 0)).all())
+
+    def test_chunk_cache(self):
+        """
+        Test that chunks read through the chunk cache parse the same.
+        """
+        batch_size = 4
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunks, record = self.write_v5_chunks(tmpdir, 2, 3)
+            cache_dir = os.path.join(tmpdir, 'cache')
+            parser = ChunkParser(chunks,
+                                 1,
+                                 shuffle_size=8,
+                                 workers=1,
+                                 batch_size=batch_size,
+                                 chunk_cache_dir=cache_dir,
+                                 chunk_cache_size=1 << 20)
+            truth = [
+                x.tobytes()
+                for x in parser.convert_v5_batch(record * batch_size)
+            ]
+            batchgen = parser.parse()
+            # Enough batches that both chunks are read again from the cache.
+            for _ in range(8):
+                self.assertEqual(list(next(batchgen)), truth)
+            parser.shutdown()
+            for chunk in chunks:
+                self.assertIsNotNone(parser.chunk_cache.load(chunk))
+
+    def test_worker_throughput(self):
+        """
+        Test the per worker counters of records received.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunks, record = self.write_v5_chunks(tmpdir, 2, 3)
+            for transport in ['pipe', 'shm']:
+                parser = ChunkParser(chunks,
+                                     1,
+                                     workers=2,
+                                     batch_size=4,
+                                     transport=transport)
+                batchgen = parser.parse()
+                for _ in range(4):
+                    next(batchgen)
+                # Records may be read ahead of the batches yielded.
+                self.assertGreaterEqual(sum(parser.worker_items), 4 * 4)
+                throughput = parser.worker_throughput()
+                self.assertEqual(len(throughput), 2)
+                self.assertGreater(sum(throughput), 0)
+                parser.shutdown()
+
+    def test_stage_stats(self):
+        """
+        Test that profiled stages are counted in the workers and parent.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunks, record = self.write_v5_chunks(tmpdir, 2, 3)
+            for worker_decode in [False, True]:
+                parser = ChunkParser(chunks,
+                                     1,
+                                     workers=2,
+                                     batch_size=4,
+                                     worker_decode=worker_decode,
+                                     profile_stages=True)
+                batchgen = parser.parse()
+                for _ in range(4):
+                    next(batchgen)
+                stats = parser.stage_stats()
+                if worker_decode:
+                    self.assertGreaterEqual(stats['parent/receive'][1], 4)
+                    self.assertGreaterEqual(stats['worker/decode'][1], 4)
+                else:
+                    self.assertEqual(stats['parent/decode'][1], 4)
+                    self.assertGreaterEqual(stats['worker/read'][1], 4 * 4)
+                self.assertGreater(stats['worker/send'][1], 0)
+                per_worker = parser.stage_stats(per_worker=True)
+                self.assertTrue(
+                    all(items >= 0 for _, items in per_worker.values()))
+                parser.shutdown()
+
+    def test_sample_indices(self):
+        """
+        Test that down-sampling keeps 1/sample of the records.
+        """
+        for num_records in [0, 1, 100000]:
+            indices = ChunkParser.sample_indices(num_records, 32)
+            self.assertTrue((np.diff(indices) > 0).all())
+            self.assertTrue(((0 <= indices) & (indices < num_records)).all())
+        self.assertAlmostEqual(len(indices) / num_records, 1 / 32, places=2)
+
+    def test_select_chunks(self):
+        """
+        Test that trainers read disjoint shares of the chunks.
+        """
+        chunks = ['chunk{}.gz'.format(i) for i in range(10)]
+        for seed in [None, 7]:
+            splits = []
+            for epoch in range(3):
+                shares = [
+                    select_chunks(chunks, rank, 3, seed, epoch)
+                    for rank in range(3)
+                ]
+                self.assertEqual(sorted(sum(shares, [])), sorted(chunks))
+                self.assertEqual(
+                    shares[1], select_chunks(chunks, 1, 3, seed, epoch))
+                splits.append(shares)
+            if seed is None:
+                self.assertEqual(splits[0], splits[1])
+            else:
+                self.assertNotEqual(splits[0], splits[1])
+
+    def test_shards(self):
+        """
+        Test reading chunks packed into a shard, in full and sampled.
+        """
+        batch_size = 4
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunks, record = self.write_v5_chunks(tmpdir, 2, 3)
+            filename = os.path.join(tmpdir, 'test' + cs.SHARD_EXTENSION)
+            writer = cs.ShardWriter(filename, block_records=2)
+            for chunk in chunks:
+                writer.add_game(chunkcodec.read_chunk(chunk))
+            writer.close()
+            for sample in [1, 2]:
+                parser = ChunkParser(cs.shard_chunks(filename, 2),
+                                     1,
+                                     shuffle_size=8,
+                                     sample=sample,
+                                     workers=1,
+                                     batch_size=batch_size)
+                truth = [
+                    x.tobytes()
+                    for x in parser.convert_v5_batch(record * batch_size)
+                ]
+                batchgen = parser.parse()
+                for _ in range(4):
+                    self.assertEqual(list(next(batchgen)), truth)
+                parser.shutdown()
+
+    def test_open_shards(self):
+        """
+        Test that the least recently read shards are closed past
+        MAX_OPEN_SHARDS.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            chunks, record = self.write_v5_chunks(tmpdir, 1, 3)
+            shards = []
+            for i in range(3):
+                filename = os.path.join(tmpdir,
+                                        '{}{}'.format(i, cs.SHARD_EXTENSION))
+                writer = cs.ShardWriter(filename)
+                writer.add_game(chunkcodec.read_chunk(chunks[0]))
+                writer.close()
+                shards.append(filename)
+            parser = ChunkParser([], 1, workers=1)
+            parser.shutdown()
+            parser.MAX_OPEN_SHARDS = 2
+            readers = []
+            for filename in shards[:2] + shards[:1] + shards[2:]:
+                self.assertEqual(len(list(parser.shard_records(filename, 0,
+                                                               1))), 3)
+                readers.append(parser.shards[filename])
+            self.assertEqual(list(parser.shards), [shards[0], shards[2]])
+            self.assertIs(readers[0], readers[2])
+            self.assertTrue(readers[1].file.closed)
+            self.assertFalse(readers[0].file.closed)
+            for reader in parser.shards.values():
+                reader.close()
 
     def test_parsing(self):
         """
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+#
+# Packed multi-game shard format for training data
+#
+# A shard holds many games in one file, so the data pipeline doesn't pay
+# a glob entry, an open and a gzip header per game. Records are grouped
+# into blocks of at most block_records records, each block compressed on
+# its own with any chunkcodec codec (or stored uncompressed), and a footer
+# index maps record ranges to blocks and games to record ranges. Reading a
+# few records only needs the blocks holding them.
+#
+# Layout:
+#   header   MAGIC, format version
+#   blocks   back to back
+#   index    BLOCK_DTYPE array, then GAME_DTYPE array
+#   trailer  TRAILER: MAGIC, number of blocks, number of games, index offset
+
+import os
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+
+import chunkcodec
+
+MAGIC = b'LZSH'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('<4sI')
+TRAILER = struct.Struct('<4sIIQ')
+SHARD_EXTENSION = '.shard'
+
+# Record sizes of the v3, v4 and v5 training data formats.
+RECORD_SIZES = {
+    struct.pack('i', 3): 8276,
+    struct.pack('i', 4): 8292,
+    struct.pack('i', 5): 8308,
+}
+
+# offset: file offset of the block, size: its compressed size,
+# record_size: size of the records in the block (one version per block),
+# first_record: index of its first record in the shard, num_records:
+# records in the block.
+BLOCK_DTYPE = np.dtype([('offset', '<u8'), ('size', '<u4'),
+                        ('record_size', '<u4'), ('first_record', '<u8'),
+                        ('num_records', '<u4')])
+# first_record: index of the first record of the game in the shard,
+# plies: number of records of the game.
+GAME_DTYPE = np.dtype([('first_record', '<u8'), ('plies', '<u4')])
+
+
+def is_shard(filename):
+    return filename.endswith(SHARD_EXTENSION)
+
+
+class ShardWriter:
+    """
+    Writes games into a new shard file.
+    """
+
+    def __init__(self, filename, codec='gzip', block_records=16):
+        """
+        Args:
+            filename: Shard file to create
+            codec: chunkcodec codec name used for the blocks
+            block_records: Maximum number of records per block. Smaller
+                blocks compress less well, but sampling reads less data.
+        """
+        self.codec = chunkcodec.CODECS[codec]
+        self.block_records = block_records
+        self.file = open(filename, 'xb')
+        self.file.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        self.blocks = []
+        self.games = []
+        self.pending = []
+        self.num_records = 0
+        self.record_size = None
+
+    def add_game(self, data):
+        """
+        Append one game, the decompressed contents of a training chunk.
+        A trailing partial record is dropped.
+        """
+        record_size = RECORD_SIZES.get(data[0:4])
+        if record_size is None:
+            raise ValueError("Unknown version {}".format(data[0:4]))
+        if record_size != self.record_size:
+            # Blocks hold records of one version only.
+            self.flush()
+            self.record_size = record_size
+        plies = len(data) // record_size
+        self.games.append((self.num_records, plies))
+        for i in range(0, plies * record_size, record_size):
+            self.pending.append(data[i:i + record_size])
+            self.num_records += 1
+            if len(self.pending) == self.block_records:
+                self.flush()
+
+    def flush(self):
+        """
+        Compress and write the pending records as one block.
+        """
+        if not self.pending:
+            return
+        data = self.codec.compress(b''.join(self.pending))
+        self.blocks.append((self.file.tell(), len(data), self.record_size,
+                            self.num_records - len(self.pending),
+                            len(self.pending)))
+        self.file.write(data)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        index_offset = self.file.tell()
+        self.file.write(np.array(self.blocks, dtype=BLOCK_DTYPE).tobytes())
+        self.file.write(np.array(self.games, dtype=GAME_DTYPE).tobytes())
+        self.file.write(
+            TRAILER.pack(MAGIC, len(self.blocks), len(self.games),
+                         index_offset))
+        self.file.close()
+
+
+class ShardReader:
+    """
+    Reads the index of a shard, and its blocks on demand through one file
+    handle kept open until close().
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        try:
+            magic, version = HEADER.unpack(self.file.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError("{} is not a shard".format(filename))
+            if version != FORMAT_VERSION:
+                raise ValueError("{} has shard format {}, expected {}".format(
+                    filename, version, FORMAT_VERSION))
+            self.file.seek(-TRAILER.size, os.SEEK_END)
+            magic, num_blocks, num_games, index_offset = TRAILER.unpack(
+                self.file.read(TRAILER.size))
+            self.file.seek(index_offset)
+            self.blocks = np.frombuffer(self.file.read(num_blocks *
+                                                       BLOCK_DTYPE.itemsize),
+                                        dtype=BLOCK_DTYPE)
+            self.games = np.frombuffer(self.file.read(num_games *
+                                                      GAME_DTYPE.itemsize),
+                                       dtype=GAME_DTYPE)
+        except Exception:
+            self.file.close()
+            raise
+        self.num_records = int(self.blocks['first_record'][-1] +
+                               self.blocks['num_records'][-1]) \
+            if num_blocks else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def read_block(self, block):
+        """
+        Returns the decompressed records of a block.
+        """
+        offset, size = self.blocks[block][['offset', 'size']]
+        self.file.seek(int(offset))
+        return chunkcodec.decompress(self.file.read(int(size)))
+
+    def read_records(self, indices):
+        """
+        Yield the records at the given sorted shard record indices,
+        decompressing each block holding one of them once, and no others.
+        """
+        blocks = np.searchsorted(self.blocks['first_record'],
+                                 indices,
+                                 side='right') - 1
+        block = None
+        for i, b in zip(indices.tolist(), blocks.tolist()):
+            if b != block:
+                block = b
+                chunkdata = self.read_block(block)
+                first_record = int(self.blocks['first_record'][block])
+                record_size = int(self.blocks['record_size'][block])
+            begin = (i - first_record) * record_size
+            yield chunkdata[begin:begin + record_size]
+
+    def read_game(self, game):
+        """
+        Returns the records of one game.
+        """
+        first_record = int(self.games['first_record'][game])
+        plies = int(self.games['plies'][game])
+        return b''.join(
+            self.read_records(np.arange(first_record, first_record + plies)))
+
+
+def shard_chunks(filename, chunk_records=256):
+    """
+    The chunk items for a shard, (filename, begin, end) triples for
+    consecutive runs of blocks [begin, end) of about chunk_records records.
+    """
+    with ShardReader(filename) as reader:
+        blocks = reader.blocks
+    chunks = []
+    begin = 0
+    records = 0
+    for block, num_records in enumerate(blocks['num_records'].tolist()):
+        records += num_records
+        if records >= chunk_records or block == len(blocks) - 1:
+            chunks.append((filename, begin, block + 1))
+            begin = block + 1
+            records = 0
+    return chunks
+
+
+class ChunkShardTest(unittest.TestCase):
+    def test_round_trip(self):
+        v5 = struct.pack('i', 5)
+        v4 = struct.pack('i', 4)
+        games = [
+            v5 + bytes([i]) * (8308 * (i + 1) - 4) for i in range(3)
+        ] + [v4 + bytes(8292 * 2 - 4)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'test' + SHARD_EXTENSION)
+            writer = ShardWriter(filename, block_records=4)
+            for game in games:
+                writer.add_game(game)
+            writer.close()
+
+            reader = ShardReader(filename)
+            self.assertEqual(len(reader.games), 4)
+            # The v5 games fill one block and part of a second, the v4
+            # game starts a new one.
+            self.assertEqual(reader.blocks['num_records'].tolist(),
+                             [4, 2, 2])
+            self.assertEqual(reader.games['plies'].tolist(), [1, 2, 3, 2])
+            for i, game in enumerate(games):
+                self.assertEqual(reader.read_game(i), game)
+            self.assertEqual(reader.read_block(0),
+                             games[0] + games[1] + games[2][:8308])
+            reader.close()
+            self.assertTrue(reader.file.closed)
+            self.assertEqual(shard_chunks(filename, 5), [(filename, 0, 2),
+                                                         (filename, 2, 3)])
+
+    def test_read_records(self):
+        v5 = struct.pack('i', 5)
+        records = [v5 + bytes([i]) * (8308 - 4) for i in range(10)]
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'test' + SHARD_EXTENSION)
+            writer = ShardWriter(filename, block_records=3)
+            writer.add_game(b''.join(records))
+            writer.close()
+
+            reader = ShardReader(filename)
+            read = []
+            reader.read_block = lambda block: read.append(block) or \
+                ShardReader.read_block(reader, block)
+            out = list(reader.read_records(np.array([1, 2, 9])))
+            self.assertEqual(out, [records[1], records[2], records[9]])
+            # Only the blocks holding the records were decompressed.
+            self.assertEqual(read, [0, 3])
+            reader.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+#
+# Pack training chunk files into chunkshard shards
+#
+# Games are taken in game number order, so each shard holds a run of
+# consecutive games and is named after the first and last of them.
+
+import argparse
+import glob
+import os
+
+import chunkcodec
+import chunkshard
+
+
+def main():
+    argparser = argparse.ArgumentParser(
+        description='Pack training.*.gz files into shards.')
+    argparser.add_argument('-i', '--input', type=str, help='input directory')
+    argparser.add_argument('-o', '--output', type=str, help='output directory')
+    argparser.add_argument('-n',
+                           '--number',
+                           type=int,
+                           default=10000,
+                           help='number of games per shard')
+    argparser.add_argument('-c',
+                           '--codec',
+                           default='gzip',
+                           choices=list(chunkcodec.CODECS),
+                           help='block compression')
+    argparser.add_argument('-b',
+                           '--block-records',
+                           type=int,
+                           default=16,
+                           help='records per compressed block')
+    argv = argparser.parse_args()
+
+    if not os.path.exists(argv.output):
+        os.makedirs(argv.output)
+        print("Created directory '{}'".format(argv.output))
+
+    # Sort by game number so shards hold consecutive games.
+    filenames = sorted(glob.glob(os.path.join(argv.input, 'training.*.gz')),
+                       key=lambda f: int(os.path.basename(f).split('.')[-2]))
+    for i in range(0, len(filenames), argv.number):
+        names = filenames[i:i + argv.number]
+        first = os.path.basename(names[0]).split('.')[-2]
+        last = os.path.basename(names[-1]).split('.')[-2]
+        fout_name = os.path.join(argv.output,
+                                 '{}-{}{}'.format(first, last,
+                                                  chunkshard.SHARD_EXTENSION))
+        writer = chunkshard.ShardWriter(fout_name, argv.codec,
+                                        argv.block_records)
+        for name in names:
+            writer.add_game(chunkcodec.read_chunk(name))
+        writer.close()
+        print("Written '{}' {} games in {} blocks".format(
+            fout_name, len(writer.games), len(writer.blocks)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+#
+# Shared memory ring buffer used to move records from the ChunkParser
+# workers to the parent without pipes.
+
+import multiprocessing as mp
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
+
+class SharedRingBuffer:
+    """
+    A ring of fixed size slots in shared memory, written by exactly one
+    producer process and read by exactly one consumer process.
+
+    The producer copies each item into the next free slot. The consumer
+    gets a numpy view of the oldest filled slot, and hands the slot back
+    with release() once it is done with the view. Slot ownership is
+    tracked by two semaphores, so no data passes through the kernel.
+    """
+
+    def __init__(self, slot_size, num_slots, ready=None):
+        """
+        Args:
+            slot_size: Size of each slot in bytes
+            num_slots: Number of slots in the ring
+            ready: Optional semaphore shared by several rings, released
+                once for every item put, so a consumer of all of them can
+                block on it until one of them has an item
+        """
+        if shared_memory is None:
+            raise ValueError(
+                "Shared memory transport requires Python 3.8 or later")
+        self.slot_size = slot_size
+        self.num_slots = num_slots
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=slot_size * num_slots)
+        self.slots = np.ndarray((num_slots, slot_size),
+                                dtype=np.uint8,
+                                buffer=self.shm.buf)
+        self.free = mp.Semaphore(num_slots)
+        self.filled = mp.Semaphore(0)
+        self.ready = ready
+        # Each side only ever advances its own index, the semaphores keep
+        # them in step.
+        self.head = 0
+        self.tail = 0
+
+    def put(self, *parts):
+        """
+        Copy parts back to back into the next free slot, waiting for one
+        to become free if the ring is full.
+
+        Args:
+            parts: bytes-like objects, slot_size bytes in total
+        """
+        self.free.acquire()
+        slot = self.slots[self.head]
+        offset = 0
+        for part in parts:
+            part = np.frombuffer(part, dtype=np.uint8)
+            slot[offset:offset + len(part)] = part
+            offset += len(part)
+        assert offset == self.slot_size
+        self.head = (self.head + 1) % self.num_slots
+        self.filled.release()
+        if self.ready is not None:
+            self.ready.release()
+
+    def get(self, timeout=None):
+        """
+        Return a view of the oldest filled slot. The view stays valid until
+        release() is called.
+
+        Args:
+            timeout: Seconds to wait for a filled slot, None to wait forever
+
+        Returns:
+            A uint8 numpy array of slot_size bytes, or None on timeout
+        """
+        if not self.filled.acquire(timeout=timeout):
+            return None
+        return self.slots[self.tail]
+
+    def release(self):
+        """
+        Hand the slot returned by the last get() back to the producer.
+        """
+        self.tail = (self.tail + 1) % self.num_slots
+        self.free.release()
+
+    def close(self):
+        """
+        Detach from and remove the shared memory block.
+        """
+        self.slots = None
+        self.shm.close()
+        self.shm.unlink()
@@ -3,15 +3,20 @@
 # Shuffle buffer implementation for data pipeline
 # Provides efficient shuffling of binary records
 
+import numpy as np
 import random
+import unittest
 
 
 class ShuffleBuffer:
     """
     A buffer that maintains a random sample of items.
     When full, returns a random item for each new item inserted.
+
+    Records are kept in one preallocated (buffer_size, record_size) uint8
+    array, so inserting and extracting never allocates per record.
     """
-    
+
     def __init__(self, record_size, buffer_size):
         """
         Args:
@@ -20,41 +25,167 @@ class ShuffleBuffer:
         """
         self.record_size = record_size
         self.buffer_size = buffer_size
-        self.buffer = []
+        self.buffer = np.empty((buffer_size, record_size), dtype=np.uint8)
+        self.used = 0
         self.count = 0
 
     def insert_or_replace(self, item):
         """
         Insert an item into the buffer. If buffer is full,
         return a random item to be replaced.
-        
+
         Args:
-            item: The record to insert (bytes)
-            
+            item: The record to insert (bytes-like)
+
         Returns:
             A random item from the buffer if full, None otherwise
         """
-        if len(self.buffer) < self.buffer_size:
-            self.buffer.append(item)
-            self.count += 1
+        item = np.frombuffer(item, dtype=np.uint8)
+        if len(item) != self.record_size:
+            raise ValueError('Record size {} does not match {}'.format(
+                len(item), self.record_size))
+        self.count += 1
+        if self.used < self.buffer_size:
+            self.buffer[self.used] = item
+            self.used += 1
             return None
         else:
             # Buffer is full, replace a random item
             idx = random.randint(0, self.buffer_size - 1)
-            old_item = self.buffer[idx]
+            old_item = self.buffer[idx].tobytes()
             self.buffer[idx] = item
-            self.count += 1
             return old_item
 
     def extract(self):
         """
         Extract a random item from the buffer.
-        
+
         Returns:
             A random item from the buffer, or None if empty
         """
-        if not self.buffer:
+        if not self.used:
             return None
-        idx = random.randint(0, len(self.buffer) - 1)
-        return self.buffer.pop(idx)
+        idx = random.randint(0, self.used - 1)
+        item = self.buffer[idx].tobytes()
+        # Swap the last record into the hole.
+        self.used -= 1
+        self.buffer[idx] = self.buffer[self.used]
+        return item
+
+    def insert_or_replace_batch(self, items):
+        """
+        Insert many items at once. Equivalent to calling insert_or_replace
+        on each item in order and collecting the replaced items.
+
+        Args:
+            items: uint8 array of shape (n, record_size), or bytes-like
+                holding n records
+
+        Returns:
+            uint8 array of shape (m, record_size) holding the replaced
+            items, m is 0 until the buffer is full.
+        """
+        items = np.frombuffer(items, dtype=np.uint8).reshape(
+            -1, self.record_size)
+        self.count += len(items)
+        fill = min(len(items), self.buffer_size - self.used)
+        self.buffer[self.used:self.used + fill] = items[:fill]
+        self.used += fill
+        items = items[fill:]
+        if not len(items):
+            return np.empty((0, self.record_size), dtype=np.uint8)
+
+        idx = np.random.randint(0, self.buffer_size, size=len(items))
+        replaced = self.buffer[idx]
+        # Items landing on a slot already hit earlier in this batch replace
+        # the earlier item rather than the one that was in the buffer.
+        order = np.argsort(idx, kind='stable')
+        sorted_idx = idx[order]
+        repeat = np.flatnonzero(sorted_idx[1:] == sorted_idx[:-1]) + 1
+        replaced[order[repeat]] = items[order[repeat - 1]]
+        # Only the last item landing on each slot stays in the buffer.
+        last = np.append(sorted_idx[1:] != sorted_idx[:-1], True)
+        self.buffer[sorted_idx[last]] = items[order[last]]
+        return replaced
+
+    def extract_batch(self, n):
+        """
+        Extract up to n random items at once.
+
+        Returns:
+            uint8 array of shape (min(n, items held), record_size)
+        """
+        n = min(n, self.used)
+        idx = np.array(random.sample(range(self.used), n), dtype=np.int64)
+        items = self.buffer[idx]
+        # Fill holes below the new end with the surviving records above it.
+        end = self.used - n
+        holes = idx[idx < end]
+        tail = np.arange(end, self.used)
+        survivors = tail[~np.isin(tail, idx)]
+        self.buffer[holes] = self.buffer[survivors]
+        self.used = end
+        return items
+
+
+class ShuffleBufferTest(unittest.TestCase):
+    def test_extract(self):
+        sb = ShuffleBuffer(3, 1)
+        r = sb.insert_or_replace(b'111')
+        assert r is None
+        r = sb.extract()
+        assert r == b'111'
+        r = sb.extract()
+        assert r is None
+
+    def test_wrong_size(self):
+        sb = ShuffleBuffer(3, 1)
+        try:
+            sb.insert_or_replace(b'1')  # wrong length, so should throw.
+            assert False  # Should not be reached.
+        except ValueError:
+            pass
+
+    def test_insert_or_replace(self):
+        n = 10  # number of test items.
+        items = [bytes([x, x, x]) for x in range(n)]
+        sb = ShuffleBuffer(record_size=3, buffer_size=len(items))
+        out = []
+        for i in items:
+            r = sb.insert_or_replace(i)
+            if r is not None:
+                out.append(r)
+        # Buffer size is the same as the number of items, so no items
+        # should have been extracted.
+        assert len(out) == 0
+        # Two passes, so both insert_or_replace and extract are exercised.
+        for i in items:
+            r = sb.insert_or_replace(i)
+            out.append(r)
+        while True:
+            r = sb.extract()
+            if r is None:
+                break
+            out.append(r)
+        # Every item went in twice and must come out twice.
+        assert sorted(out) == sorted(items * 2)
+
+    def test_batches(self):
+        n = 8
+        sb = ShuffleBuffer(record_size=2, buffer_size=n)
+        items = np.repeat(np.arange(5 * n, dtype=np.uint8), 2).reshape(-1, 2)
+        out = [sb.insert_or_replace_batch(items[:n // 2])]
+        assert len(out[0]) == 0
+        # Many more items than slots, so slots are hit repeatedly.
+        out.append(sb.insert_or_replace_batch(items[n // 2:]))
+        assert len(out[1]) == len(items) - n
+        out.append(sb.extract_batch(3))
+        out.append(sb.extract_batch(n))
+        assert len(out[3]) == n - 3
+        assert len(sb.extract_batch(1)) == 0
+        out = np.concatenate(out)
+        assert sorted(out[:, 0].tolist()) == list(range(5 * n))
+
 
+if __name__ == '__main__':
+    unittest.main()
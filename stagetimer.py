@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+#
+# Time spent in the stages of a generator pipeline, used to profile the
+# ChunkParser workers and parent.
+
+import multiprocessing as mp
+import time
+import unittest
+
+import numpy as np
+
+
+class StageTimer:
+    """
+    Seconds spent in and items passed through each stage of a chain of
+    generators, each stage consuming the one before it.
+
+    Time is measured around each next() of a stage, so it includes the
+    time of the stages before it; totals() subtracts those again. Direct
+    stages sit outside of the chain and are timed with add(). With
+    shared, the counters live in shared memory, so that a forked worker
+    can update them and its parent read them. Only one process may update
+    a timer.
+    """
+
+    def __init__(self, stages, direct=(), shared=False):
+        """
+        Args:
+            stages: Stage names, in the order they consume each other
+            direct: Names of stages timed with add()
+            shared: Keep the counters in shared memory
+        """
+        self.chain = len(stages)
+        self.stages = list(stages) + list(direct)
+        n = len(self.stages)
+        if shared:
+            counters = np.frombuffer(mp.RawArray('d', 2 * n),
+                                     dtype=np.float64)
+        else:
+            counters = np.zeros(2 * n)
+        self.seconds = counters[:n]
+        self.items = counters[n:]
+
+    def wrap(self, gen, stage):
+        """
+        Yield the items of gen, timing them as stage.
+        """
+        i = self.stages.index(stage)
+        gen = iter(gen)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(gen)
+            except StopIteration:
+                return
+            self.seconds[i] += time.perf_counter() - start
+            self.items[i] += 1
+            yield item
+
+    def add(self, stage, seconds, items=1):
+        """
+        Record seconds spent in a direct stage.
+        """
+        i = self.stages.index(stage)
+        self.seconds[i] += seconds
+        self.items[i] += items
+
+    def totals(self):
+        """
+        Returns {stage: (seconds, items)} so far, with the seconds of each
+        stage excluding the stages before it.
+        """
+        seconds = self.seconds.copy()
+        items = self.items.copy()
+        totals = {}
+        inner = 0.0
+        for i, stage in enumerate(self.stages):
+            if not items[i]:
+                continue
+            if i < self.chain:
+                totals[stage] = (max(seconds[i] - inner, 0.0), items[i])
+                inner = seconds[i]
+            else:
+                totals[stage] = (seconds[i], items[i])
+        return totals
+
+
+class StageTimerTest(unittest.TestCase):
+    def test_chain(self):
+        timer = StageTimer(['inner', 'outer'], direct=['consumer'])
+
+        def inner():
+            for i in range(4):
+                time.sleep(0.01)
+                yield i
+
+        def outer(gen):
+            for i in gen:
+                time.sleep(0.02)
+                yield i
+
+        for _ in timer.wrap(outer(timer.wrap(inner(), 'inner')), 'outer'):
+            timer.add('consumer', 0.5)
+        totals = timer.totals()
+        self.assertEqual(totals['inner'][1], 4)
+        self.assertEqual(totals['outer'][1], 4)
+        self.assertAlmostEqual(totals['inner'][0], 0.04, delta=0.03)
+        self.assertAlmostEqual(totals['outer'][0], 0.08, delta=0.03)
+        self.assertEqual(totals['consumer'], (2.0, 4))
+
+    def test_shared(self):
+        timer = StageTimer([], direct=['stage'], shared=True)
+        p = mp.Process(target=timer.add, args=('stage', 1.5, 3))
+        p.start()
+        p.join()
+        self.assertEqual(timer.totals(), {'stage': (1.5, 3)})
+
+
+if __name__ == '__main__':
+    unittest.main()
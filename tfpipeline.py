@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+#
+# Training input pipeline built only from tf.data ops
+#
+# An alternative to ChunkParser for v5 gzip chunks: files are read and
+# decompressed by tf.data, and records are shuffled, batched and unpacked
+# to tensors in graph ops, so no Python runs per record or per batch.
+
+import gzip
+import os
+import struct
+import tempfile
+import unittest
+
+import numpy as np
+import tensorflow as tf
+
+import chunkparser
+
+V5_RECORD_SIZE = chunkparser.V5_DTYPE.itemsize
+PACKED_PLANES_SIZE = chunkparser.PACKED_PLANES_SIZE
+MAX_LEGAL_MOVES = chunkparser.MAX_LEGAL_MOVES
+# The single byte fields following the 832 bytes of bit planes, in record
+# order. Packed planes are these 840 bytes of the record as is.
+PACKED_FIELDS = [
+    'us_ooo', 'us_oo', 'them_ooo', 'them_oo', 'stm', 'rule50_count',
+    'dep_ply_count', 'result'
+]
+
+
+def field_offset(name):
+    return chunkparser.V5_DTYPE.fields[name][1]
+
+
+def bytes_field(records, name, count=1):
+    """
+    Slice a uint8 field of count bytes out of a (N, record size) uint8
+    tensor.
+    """
+    offset = field_offset(name)
+    return records[:, offset:offset + count]
+
+
+def float_field(records, name, count=1):
+    """
+    A float32 field of count values, as a (N, count) tensor.
+    """
+    offset = field_offset(name)
+    raw = tf.reshape(records[:, offset:offset + 4 * count], (-1, count, 4))
+    return tf.bitcast(raw, tf.float32)
+
+
+def unpack_bits(values, reverse=False):
+    """
+    Expand each byte of a (N, M) uint8 tensor into 8 float32 values, most
+    significant bit first, or least significant first with reverse.
+    """
+    shifts = tf.constant([7, 6, 5, 4, 3, 2, 1, 0], dtype=tf.uint8)
+    if reverse:
+        shifts = shifts[::-1]
+    bits = tf.bitwise.bitwise_and(
+        tf.bitwise.right_shift(tf.expand_dims(values, -1), shifts), 1)
+    return tf.reshape(tf.cast(bits, tf.float32), (-1, values.shape[1] * 8))
+
+
+def expand_planes(packed, input_format):
+    """
+    Expand a (N, PACKED_PLANES_SIZE) uint8 tensor of packed planes into the
+    (N, 112, 64) float32 input planes, as ChunkParser.convert_v5_batch does
+    on the CPU.
+    """
+    n = packed.shape[0]
+    if n is None:
+        n = tf.shape(packed)[0]
+
+    def field(name):
+        offset = PACKED_FIELDS.index(name) + 832
+        return packed[:, offset:offset + 1]
+
+    def broadcast(values):
+        return tf.tile(tf.cast(values, tf.float32), (1, 64))
+
+    zeros = tf.zeros((n, 64))
+    zeros48 = tf.zeros((n, 48))
+    zeros56 = tf.zeros((n, 56))
+    planes = [tf.reshape(unpack_bits(packed[:, :832]), (n, 104, 64))]
+    if input_format == 1:
+        extra = [
+            broadcast(field(name))
+            for name in ['us_ooo', 'us_oo', 'them_ooo', 'them_oo', 'stm']
+        ]
+    else:
+        # These fields are in opposite endian to the planes data.
+        def castling(us, them):
+            return tf.concat([
+                unpack_bits(field(us), reverse=True), zeros48,
+                unpack_bits(field(them), reverse=True)
+            ],
+                             axis=1)
+
+        if input_format == 2:
+            stm = broadcast(field('stm'))
+        else:
+            stm = tf.concat(
+                [zeros56, unpack_bits(field('stm'), reverse=True)], axis=1)
+        extra = [
+            castling('us_ooo', 'them_ooo'),
+            castling('us_oo', 'them_oo'), zeros, zeros, stm
+        ]
+
+    rule50_divisor = 99.0
+    if input_format > 3:
+        rule50_divisor = 100.0
+    extra.append(broadcast(field('rule50_count')) / rule50_divisor)
+    if input_format == 132 or input_format == 133:
+        extra.append(broadcast(field('dep_ply_count') >= 128))
+    else:
+        extra.append(zeros)
+    # Make the last plane all 1's so the NN can detect edges of the board
+    # more easily
+    extra.append(tf.ones((n, 64)))
+    return tf.concat(planes + [tf.stack(extra, axis=1)], axis=1)
+
+
+def sparse_policy_targets(probs):
+    """
+    Graph version of chunkparser.sparse_policy_batch: convert (N, 1858)
+    dense policy targets into (indices, probs) tensors of shape
+    (N, MAX_LEGAL_MOVES), padded with index -1 and probability 0.
+
+    Fails with InvalidArgumentError on rows with more than MAX_LEGAL_MOVES
+    legal moves, as sparse_policy_batch does.
+    """
+    legal = probs >= 0
+    count = tf.reduce_sum(tf.cast(legal, tf.int32), axis=1, keepdims=True)
+    with tf.control_dependencies([
+            tf.debugging.assert_less_equal(
+                count,
+                MAX_LEGAL_MOVES,
+                message='More legal moves than MAX_LEGAL_MOVES')
+    ]):
+        count = tf.identity(count)
+    # Legal moves first, each group in increasing index order.
+    order = tf.argsort(tf.cast(~legal, tf.int32), axis=1,
+                       stable=True)[:, :MAX_LEGAL_MOVES]
+    used = tf.range(MAX_LEGAL_MOVES) < count
+    indices = tf.where(used, order, -1)
+    probs = tf.where(used, tf.gather(probs, order, batch_dims=1), 0.0)
+    return indices, probs
+
+
+def decode_v5_batch(records,
+                    input_format,
+                    packed_planes=False,
+                    sparse_policy=False):
+    """
+    Graph version of ChunkParser.convert_v5_batch: unpack a (N,) tf.string
+    tensor of v5 records into (planes, probs, winner, q, plies_left) with
+    shapes (N, 112, 64), (N, 1858), (N, 3), (N, 3) and (N, ).
+
+    With packed_planes, planes are left packed as (N, PACKED_PLANES_SIZE)
+    uint8 for expand_planes to unpack inside the model. With sparse_policy,
+    probs are an (indices, probs) pair, see sparse_policy_targets.
+
+    Fails with InvalidArgumentError on records that are not v5 or not in
+    input_format, as ChunkParser does.
+    """
+    # Keep the batch dimension static when it is known.
+    n = records.shape[0]
+    records = tf.reshape(tf.io.decode_raw(records, tf.uint8),
+                         (-1 if n is None else n, V5_RECORD_SIZE))
+    version = tf.bitcast(bytes_field(records, 'version', 4), tf.int32)
+    record_format = tf.bitcast(bytes_field(records, 'input_format', 4),
+                               tf.int32)
+    with tf.control_dependencies([
+            tf.debugging.assert_equal(
+                version,
+                np.frombuffer(chunkparser.V5_VERSION, np.int32)[0],
+                message='Unknown version in v5 record'),
+            tf.debugging.assert_equal(
+                record_format,
+                tf.constant(input_format, tf.int32),
+                message='Unexpected input format in v5 record')
+    ]):
+        records = tf.identity(records)
+
+    planes = bytes_field(records, 'planes', PACKED_PLANES_SIZE)
+    if not packed_planes:
+        planes = expand_planes(planes, input_format)
+
+    probs = float_field(records, 'probs', 1858)
+    if sparse_policy:
+        probs = sparse_policy_targets(probs)
+
+    result = tf.bitcast(bytes_field(records, 'result'), tf.int8)[:, 0]
+    winner = tf.cast(tf.stack([result == 1, result == 0, result == -1],
+                              axis=1),
+                     tf.float32)
+
+    best_q = tf.cast(float_field(records, 'best_q')[:, 0], tf.float64)
+    best_d = tf.cast(float_field(records, 'best_d')[:, 0], tf.float64)
+    q = tf.cast(tf.stack([
+        0.5 * (1.0 - best_d + best_q), best_d, 0.5 * (1.0 - best_d - best_q)
+    ],
+                         axis=1),
+                tf.float32)
+
+    # v3/4 data sometimes has a useful value in dep_ply_count, so copy
+    # that over if the new ply_count is not populated.
+    plies_left = float_field(records, 'plies_left')[:, 0]
+    dep_ply_count = bytes_field(records, 'dep_ply_count')
+    plies_left = tf.where(plies_left == 0,
+                          tf.cast(dep_ply_count[:, 0], tf.float32),
+                          plies_left)
+
+    return (planes, probs, winner, q, plies_left)
+
+
+def make_dataset(chunks,
+                 expected_input_format,
+                 batch_size,
+                 shuffle_size=1,
+                 cycle_length=16,
+                 packed_planes=False,
+                 sparse_policy=False,
+                 sample=1):
+    """
+    Build a repeating dataset of batched training tensors from gzipped v5
+    chunk files, yielding the same tensors as ChunkParser.parse_function.
+
+    'chunks' list of chunk filenames, read in shuffled order every epoch.
+    'shuffle_size' is the size of the record shuffle buffer.
+    'cycle_length' is the number of files read concurrently.
+    'packed_planes' leaves the planes packed, see decode_v5_batch.
+    'sparse_policy' yields sparse policy targets, see decode_v5_batch.
+    'sample' keeps each record with probability 1/sample, as ChunkParser.
+    """
+    for chunk in chunks:
+        if not isinstance(chunk, str) or not chunk.endswith('.gz'):
+            raise ValueError(
+                "The tf pipeline reads gzipped chunk files only, not {}".
+                format(chunk))
+    files = tf.data.Dataset.from_tensor_slices(chunks)
+    files = files.shuffle(len(chunks), reshuffle_each_iteration=True).repeat()
+    records = files.interleave(
+        lambda filename: tf.data.FixedLengthRecordDataset(
+            filename, V5_RECORD_SIZE, compression_type='GZIP'),
+        cycle_length=cycle_length,
+        num_parallel_calls=tf.data.AUTOTUNE)
+    if sample > 1:
+        records = records.filter(
+            lambda record: tf.random.uniform(()) < 1.0 / sample)
+    if shuffle_size > 1:
+        records = records.shuffle(shuffle_size)
+    dataset = records.batch(batch_size, drop_remainder=True)
+    dataset = dataset.map(
+        lambda batch: decode_v5_batch(batch, expected_input_format,
+                                      packed_planes, sparse_policy),
+        num_parallel_calls=tf.data.AUTOTUNE)
+    options = tf.data.Options()
+    # Record order is random anyway, don't wait on slow files.
+    options.experimental_deterministic = False
+    return dataset.with_options(options).prefetch(tf.data.AUTOTUNE)
+
+
+class TFPipelineTest(unittest.TestCase):
+    def random_records(self, n, input_format):
+        records = np.zeros(n, dtype=chunkparser.V5_DTYPE)
+        raw = records.view(np.uint8).reshape(n, -1)
+        raw[:] = np.random.randint(0, 256, size=raw.shape)
+        records['version'] = chunkparser.V5_VERSION
+        records['input_format'] = input_format
+        records['probs'] = np.random.random((n, 1858))
+        records['result'] = np.random.randint(-1, 2, size=n)
+        records['best_q'] = np.random.uniform(-1, 1, size=n)
+        records['best_d'] = np.random.uniform(0, 1, size=n)
+        records['plies_left'] = np.random.randint(0, 3, size=n)
+        for field in ['root_q', 'root_d', 'root_m', 'best_m']:
+            records[field] = 0
+        if input_format < 3:
+            for field in ['us_ooo', 'us_oo', 'them_ooo', 'them_oo', 'stm']:
+                records[field] = np.random.randint(0, 2, size=n)
+        return records
+
+    def test_decode_matches_chunkparser(self):
+        batch_size = 8
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for input_format in [1, 2, 3, 5, 133]:
+                records = self.random_records(batch_size, input_format)
+                filename = os.path.join(tmpdir,
+                                        'training.{}.gz'.format(input_format))
+                with gzip.open(filename, 'wb') as f:
+                    f.write(records.tobytes())
+                parser = chunkparser.ChunkParser([filename],
+                                                 input_format,
+                                                 workers=1,
+                                                 batch_size=batch_size)
+                truth = parser.convert_v5_batch(records.tobytes())
+                parser.packed_planes = True
+                packed = parser.convert_v5_batch(records.tobytes())[0]
+                parser.shutdown()
+                self.assertTrue((expand_planes(tf.constant(packed),
+                                               input_format).numpy() ==
+                                 truth[0]).all())
+                # One file at a time, so the records come in file order.
+                dataset = make_dataset([filename],
+                                       input_format,
+                                       batch_size,
+                                       cycle_length=1)
+                batch = next(iter(dataset))
+                for x, y in zip(batch, truth):
+                    self.assertEqual(x.shape, y.shape)
+                    self.assertTrue((x.numpy() == y).all())
+                dataset = make_dataset([filename],
+                                       input_format,
+                                       batch_size,
+                                       cycle_length=1,
+                                       packed_planes=True)
+                planes = next(iter(dataset))[0]
+                self.assertEqual(planes.shape, (batch_size,
+                                                PACKED_PLANES_SIZE))
+                self.assertTrue((expand_planes(planes, input_format).numpy()
+                                 == truth[0]).all())
+
+    def test_sparse_policy(self):
+        batch_size = 8
+        chunkparser.ChunkParser.BATCH_SIZE = batch_size
+        records = self.random_records(batch_size, 1)
+        probs = -np.ones((batch_size, 1858), dtype=np.float32)
+        for i in range(batch_size):
+            legal = np.random.choice(1858, 20 + i, replace=False)
+            probs[i, legal] = np.random.random(len(legal))
+        records['probs'] = probs
+        parser = chunkparser.ChunkParser([], 1, workers=1)
+        parser.sparse_policy = True
+        batch = parser.convert_v5_batch(records.tobytes())
+        parser.shutdown()
+        sparse = batch[1]
+        # Scattering the legal moves back gives the dense targets.
+        dense = np.zeros((batch_size, 1858), dtype=np.float32)
+        for i in range(batch_size):
+            used = sparse['index'][i] >= 0
+            self.assertEqual(used.sum(), 20 + i)
+            dense[i, sparse['index'][i][used]] = sparse['prob'][i][used]
+        self.assertTrue((dense == np.maximum(probs, 0)).all())
+        # Both pipelines deliver the same tensors.
+        tf_batch = decode_v5_batch(tf.constant(
+            [r.tobytes() for r in records]),
+                                   1,
+                                   sparse_policy=True)
+        parsed = chunkparser.ChunkParser.parse_function(
+            *[x.tobytes() for x in batch], sparse_policy=True)
+        for indices, values in [tf_batch[1], parsed[1]]:
+            self.assertTrue((indices.numpy() == sparse['index']).all())
+            self.assertTrue((values.numpy() == sparse['prob']).all())
+        # Both reject rows with too many legal moves.
+        probs[0] = 0
+        with self.assertRaises(AssertionError):
+            chunkparser.sparse_policy_batch(probs)
+        with self.assertRaises(tf.errors.InvalidArgumentError):
+            sparse_policy_targets(tf.constant(probs))
+
+    def test_rejects_bad_records(self):
+        batch_size = 4
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'training.0.gz')
+            records = self.random_records(batch_size, 1)
+            records['version'] = struct.pack('i', 4)
+            with gzip.open(filename, 'wb') as f:
+                f.write(records.tobytes())
+            with self.assertRaises(tf.errors.InvalidArgumentError):
+                next(iter(make_dataset([filename], 1, batch_size)))
+            records = self.random_records(batch_size, 1)
+            with gzip.open(filename, 'wb') as f:
+                f.write(records.tobytes())
+            with self.assertRaises(tf.errors.InvalidArgumentError):
+                next(iter(make_dataset([filename], 3, batch_size)))
+            with self.assertRaises(ValueError):
+                make_dataset([os.path.join(tmpdir, 'training.0.zst')], 1,
+                             batch_size)
+
+    def test_sample(self):
+        batch_size = 400
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'training.0.gz')
+            records = self.random_records(batch_size, 1)
+            records['plies_left'] = np.arange(1, batch_size + 1)
+            with gzip.open(filename, 'wb') as f:
+                f.write(records.tobytes())
+            # Unsampled, a batch is the file once over.
+            dataset = make_dataset([filename], 1, batch_size, cycle_length=1)
+            plies_left = next(iter(dataset))[4].numpy()
+            self.assertEqual(sorted(plies_left.tolist()),
+                             list(range(1, batch_size + 1)))
+            # Sampled, it takes several passes over the file, each keeping
+            # different records.
+            dataset = make_dataset([filename],
+                                   1,
+                                   batch_size,
+                                   cycle_length=1,
+                                   sample=4)
+            unique = len(np.unique(next(iter(dataset))[4].numpy()))
+            self.assertLessEqual(unique, 0.85 * batch_size)
+            self.assertGreater(unique, 0.5 * batch_size)
+
+if __name__ == '__main__':
+    unittest.main()
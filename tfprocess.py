@@ -16,14 +16,18 @@
 #    You should have received a copy of the GNU General Public License
 #    along with Leela Zero.  If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import gzip
 import numpy as np
 import os
 import random
+import tempfile
 import tensorflow as tf
 import time
-import bisect
+import unittest
 import lc0_az_policy_map
 import proto.net_pb2 as pb
+import tfpipeline
 from functools import reduce
 import operator
 
@@ -31,6 +35,12 @@ from net import Net
 
 
 class ApplySqueezeExcitation(tf.keras.layers.Layer):
+    """
+    Scales and shifts the channels of x by the squeeze-excitation output.
+    Computes in the layer's compute dtype, the sigmoid gates and shifts are
+    well within float16 and bfloat16 precision.
+    """
+
     def __init__(self, **kwargs):
         super(ApplySqueezeExcitation, self).__init__(**kwargs)
 
@@ -48,14 +58,35 @@ class ApplySqueezeExcitation(tf.keras.layers.Layer):
 
 
 class ApplyPolicyMap(tf.keras.layers.Layer):
+    """
+    Maps the 80x8x8 policy planes to the 1858 policy outputs. Each output
+    is one of the plane values, so this gathers them, which is exact in
+    any compute dtype, rather than multiplying by the 0/1 map.
+    """
+
     def __init__(self, **kwargs):
         super(ApplyPolicyMap, self).__init__(**kwargs)
-        self.fc1 = tf.constant(lc0_az_policy_map.make_map())
+        self.indices = tf.constant(np.argmax(lc0_az_policy_map.make_map(),
+                                             axis=0),
+                                   dtype=tf.int32)
 
     def call(self, inputs):
         h_conv_pol_flat = tf.reshape(inputs, [-1, 80 * 8 * 8])
-        return tf.matmul(h_conv_pol_flat,
-                         tf.cast(self.fc1, h_conv_pol_flat.dtype))
+        return tf.gather(h_conv_pol_flat, self.indices, axis=1)
+
+
+class ExpandPlanes(tf.keras.layers.Layer):
+    """
+    Expands packed planes, as delivered by the input pipelines with
+    packed_planes, into the 112x64 input planes on the accelerator.
+    """
+
+    def __init__(self, input_format, **kwargs):
+        super(ExpandPlanes, self).__init__(**kwargs)
+        self.input_format = input_format
+
+    def call(self, inputs):
+        return tfpipeline.expand_planes(inputs, self.input_format)
 
 
 class TFProcess:
@@ -71,19 +102,27 @@ class TFProcess:
         self.SE_ratio = self.cfg['model']['se_ratio']
         self.policy_channels = self.cfg['model'].get('policy_channels', 32)
         precision = self.cfg['training'].get('precision', 'single')
-        loss_scale = self.cfg['training'].get('loss_scale', 128)
+        loss_scale = self.cfg['training'].get('loss_scale', 'dynamic')
         self.virtual_batch_size = self.cfg['model'].get(
             'virtual_batch_size', None)
 
+        # Mixed precision computes in model_dtype, keeping the variables in
+        # float32.
         if precision == 'single':
             self.model_dtype = tf.float32
-        elif precision == 'half':
+        elif precision in ('half', 'mixed_float16'):
             self.model_dtype = tf.float16
+        elif precision in ('bfloat16', 'mixed_bfloat16'):
+            self.model_dtype = tf.bfloat16
         else:
             raise ValueError("Unknown precision: {}".format(precision))
 
-        # Scale the loss to prevent gradient underflow
-        self.loss_scale = 1 if self.model_dtype == tf.float32 else loss_scale
+        # Scale the loss to prevent float16 gradient underflow, 'dynamic'
+        # adjusts the scale to the gradients. bfloat16 has the range of
+        # float32 and needs no scaling.
+        self.loss_scale = None
+        if self.model_dtype == tf.float16:
+            self.loss_scale = loss_scale
 
         policy_head = self.cfg['model'].get('policy', 'convolution')
         value_head = self.cfg['model'].get('value', 'wdl')
@@ -148,6 +187,10 @@ class TFProcess:
                 "Unknown input mode format: {}".format(input_mode))
 
         self.net.set_input(self.INPUT_MODE)
+        # Input planes come packed from the pipeline, see ExpandPlanes.
+        self.packed_planes = self.cfg['model'].get('packed_planes', False)
+        # Policy targets come as (indices, probs) of the legal moves.
+        self.sparse_policy = self.cfg['training'].get('sparse_policy', False)
 
         self.swa_enabled = self.cfg['training'].get('swa', False)
 
@@ -160,55 +203,125 @@ class TFProcess:
         self.renorm_momentum = self.cfg['training'].get(
             'renorm_momentum', 0.99)
             
+        # Data parallel training: 'mirrored' over the devices of this
+        # machine, or 'multi_worker' over the machines in TF_CONFIG.
+        distribute = self.cfg['training'].get('distribute')
+        # Split the CPU into this many devices, to run distributed
+        # training without GPUs.
+        virtual_devices = self.cfg['training'].get('virtual_devices', 0)
+        if virtual_devices:
+            cpus = tf.config.list_physical_devices('CPU')
+            tf.config.set_logical_device_configuration(
+                cpus[0], [tf.config.LogicalDeviceConfiguration()] *
+                virtual_devices)
+
         if gpu:
             gpus = tf.config.experimental.list_physical_devices('GPU')
-            tf.config.experimental.set_visible_devices(gpus[self.cfg['gpu']],
-                                                    'GPU')
-            tf.config.experimental.set_memory_growth(gpus[self.cfg['gpu']], True)
+            if distribute:
+                # Distributed training uses every GPU.
+                for device in gpus:
+                    tf.config.experimental.set_memory_growth(device, True)
+            else:
+                tf.config.experimental.set_visible_devices(
+                    gpus[self.cfg['gpu']], 'GPU')
+                tf.config.experimental.set_memory_growth(
+                    gpus[self.cfg['gpu']], True)
         
         if self.model_dtype == tf.float16:
-            tf.keras.mixed_precision.experimental.set_policy('mixed_float16')
-
-        self.global_step = tf.Variable(0,
-                                       name='global_step',
-                                       trainable=False,
-                                       dtype=tf.int64)
-
-    def init_v2(self, train_dataset, test_dataset, validation_dataset=None):
+            tf.keras.mixed_precision.set_global_policy('mixed_float16')
+        elif self.model_dtype == tf.bfloat16:
+            tf.keras.mixed_precision.set_global_policy('mixed_bfloat16')
+
+        if distribute == 'mirrored':
+            devices = None
+            if virtual_devices:
+                devices = [
+                    device.name
+                    for device in tf.config.list_logical_devices('CPU')
+                ]
+            self.strategy = tf.distribute.MirroredStrategy(devices)
+        elif distribute == 'multi_worker':
+            self.strategy = tf.distribute.MultiWorkerMirroredStrategy()
+        elif distribute is None:
+            self.strategy = tf.distribute.get_strategy()
+        else:
+            raise ValueError(
+                "Unknown distribute strategy: {}".format(distribute))
+        # Each batch is split evenly across the replicas.
+        replicas = self.strategy.num_replicas_in_sync
+        if self.cfg['training']['batch_size'] % replicas != 0:
+            raise ValueError('batch_size must be a multiple of {}'.format(
+                replicas))
+
+        with self.strategy.scope():
+            self.global_step = tf.Variable(
+                0,
+                name='global_step',
+                trainable=False,
+                dtype=tf.int64,
+                aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+
+    def init_v2(self,
+                train_dataset,
+                test_dataset,
+                validation_dataset=None,
+                train_parser=None):
+        # The ChunkParser feeding train_dataset, for its stage_stats().
+        self.train_parser = train_parser
+        # Batches are split across the replicas of the strategy.
         self.train_dataset = train_dataset
-        self.train_iter = iter(train_dataset)
+        self.train_iter = iter(self.distribute_dataset(train_dataset))
         self.test_dataset = test_dataset
-        self.test_iter = iter(test_dataset)
+        self.test_iter = iter(self.distribute_dataset(test_dataset))
         self.validation_dataset = validation_dataset
         self.init_net_v2()
 
-    def init_net_v2(self):
-        self.l2reg = tf.keras.regularizers.l2(l=0.5 * (0.0001))
-        input_var = tf.keras.Input(shape=(112, 8 * 8))
-        x_planes = tf.keras.layers.Reshape([112, 8, 8])(input_var)
-        policy, value, moves_left = self.construct_net_v2(x_planes)
-        if self.moves_left:
-            outputs = [policy, value, moves_left]
-        else:
-            outputs = [policy, value]
-        self.model = tf.keras.Model(inputs=input_var, outputs=outputs)
-
-        # swa_count initialized reguardless to make checkpoint code simpler.
-        self.swa_count = tf.Variable(0., name='swa_count', trainable=False)
-        self.swa_weights = None
-        if self.swa_enabled:
-            # Count of networks accumulated into SWA
-            self.swa_weights = [
-                tf.Variable(w, trainable=False) for w in self.model.weights
-            ]
-
-        self.active_lr = 0.01
-        self.optimizer = tf.keras.optimizers.SGD(
-            learning_rate=lambda: self.active_lr, momentum=0.9, nesterov=True)
-        self.orig_optimizer = self.optimizer
-        if self.loss_scale != 1:
-            self.optimizer = tf.keras.mixed_precision.experimental.LossScaleOptimizer(
-                self.optimizer, self.loss_scale)
+    def distribute_dataset(self, dataset):
+        # Each worker already reads its own share of the chunks, see
+        # train.trainer_rank(), so tf.data must not shard them again.
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = (
+            tf.data.experimental.AutoShardPolicy.OFF)
+        return self.strategy.experimental_distribute_dataset(
+            dataset.with_options(options))
+
+    def init_net_v2(self, summaries=True):
+        # Let XLA compile the training and test steps, fusing their ops.
+        if self.cfg['training'].get('jit_compile', False):
+            self.process_inner_loop = tf.function(
+                self.process_inner_loop.python_function, jit_compile=True)
+            self.calculate_test_summaries_inner_loop = tf.function(
+                self.calculate_test_summaries_inner_loop.python_function,
+                jit_compile=True)
+        # The model, optimizer and SWA variables are mirrored on every
+        # replica of the distribution strategy.
+        with self.strategy.scope():
+            self.model = self.construct_model_v2()
+
+            # swa_count initialized reguardless to make checkpoint code simpler.
+            self.swa_count = tf.Variable(0., name='swa_count', trainable=False)
+            self.swa_weights = None
+            if self.swa_enabled:
+                # Count of networks accumulated into SWA
+                self.swa_weights = [
+                    tf.Variable(w, trainable=False) for w in self.model.weights
+                ]
+
+            self.optimizer = tf.keras.optimizers.SGD(learning_rate=0.01,
+                                                     momentum=0.9,
+                                                     nesterov=True)
+            self.orig_optimizer = self.optimizer
+            # The optimizer keeps its learning rate in a variable, which the
+            # compiled training step assigns before applying gradients.
+            self.active_lr = self.orig_optimizer.learning_rate
+            if self.loss_scale == 'dynamic':
+                self.optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+                    self.optimizer)
+            elif self.loss_scale is not None:
+                self.optimizer = tf.keras.mixed_precision.LossScaleOptimizer(
+                    self.optimizer,
+                    dynamic=False,
+                    initial_scale=self.loss_scale)
 
         def correct_policy(target, output):
             output = tf.cast(output, tf.float32)
@@ -223,13 +336,53 @@ class TFProcess:
             target = tf.nn.relu(target)
             return target, output
 
+        def correct_sparse_policy(target, output):
+            # Sparse targets are (indices, probs) of the legal moves, padded
+            # with index -1 and probability 0.
+            indices, probs = target
+            output = tf.cast(output, tf.float32)
+            legal = tf.greater_equal(indices, 0)
+            legal_logits = tf.gather(output,
+                                     tf.maximum(indices, 0),
+                                     batch_dims=1)
+            if self.cfg['training'].get('mask_legal_moves'):
+                # The softmax only runs over the legal moves, the same as
+                # filling illegal logits with a large negative value.
+                output = tf.where(legal, legal_logits, -1.0e10)
+            log_z = tf.reduce_logsumexp(output, axis=1, keepdims=True)
+            # output is either all 1858 logits or the masked legal ones.
+            return indices, probs, legal, legal_logits - log_z, output
+
+        def sparse_policy_loss(target, output):
+            _, probs, _, log_probs, _ = correct_sparse_policy(target, output)
+            policy_cross_entropy = -tf.reduce_sum(
+                tf.stop_gradient(probs) * log_probs, axis=1)
+            return tf.reduce_mean(input_tensor=policy_cross_entropy)
+
         def policy_loss(target, output):
             target, output = correct_policy(target, output)
             policy_cross_entropy = tf.nn.softmax_cross_entropy_with_logits(
                 labels=tf.stop_gradient(target), logits=output)
             return tf.reduce_mean(input_tensor=policy_cross_entropy)
 
-        self.policy_loss_fn = policy_loss
+        if self.sparse_policy:
+            self.policy_loss_fn = sparse_policy_loss
+        else:
+            self.policy_loss_fn = policy_loss
+
+        def sparse_policy_accuracy(target, output):
+            indices, probs, _, _, output = correct_sparse_policy(
+                target, output)
+            target_move = tf.gather(indices,
+                                    tf.argmax(input=probs, axis=1),
+                                    batch_dims=1)
+            output_move = tf.argmax(input=output, axis=1)
+            if self.cfg['training'].get('mask_legal_moves'):
+                output_move = tf.gather(indices, output_move, batch_dims=1)
+            return tf.reduce_mean(
+                tf.cast(
+                    tf.equal(tf.cast(target_move, tf.int64),
+                             tf.cast(output_move, tf.int64)), tf.float32))
 
         def policy_accuracy(target, output):
             target, output = correct_policy(target, output)
@@ -238,7 +391,10 @@ class TFProcess:
                     tf.equal(tf.argmax(input=target, axis=1),
                              tf.argmax(input=output, axis=1)), tf.float32))
 
-        self.policy_accuracy_fn = policy_accuracy
+        if self.sparse_policy:
+            self.policy_accuracy_fn = sparse_policy_accuracy
+        else:
+            self.policy_accuracy_fn = policy_accuracy
 
         def moves_left_mean_error_fn(target, output):
             output = tf.cast(output, tf.float32)
@@ -247,7 +403,10 @@ class TFProcess:
         self.moves_left_mean_error = moves_left_mean_error_fn
 
         def policy_entropy(target, output):
-            target, output = correct_policy(target, output)
+            if self.sparse_policy:
+                output = correct_sparse_policy(target, output)[-1]
+            else:
+                target, output = correct_policy(target, output)
             softmaxed = tf.nn.softmax(output)
             return tf.math.negative(
                 tf.reduce_mean(
@@ -256,6 +415,15 @@ class TFProcess:
 
         self.policy_entropy_fn = policy_entropy
 
+        def sparse_policy_uniform_loss(target, output):
+            _, _, legal, log_probs, _ = correct_sparse_policy(target, output)
+            uniform = tf.cast(legal, tf.float32)
+            balanced_uniform = uniform / tf.reduce_sum(
+                uniform, axis=1, keepdims=True)
+            policy_cross_entropy = -tf.reduce_sum(
+                tf.where(legal, balanced_uniform * log_probs, 0.0), axis=1)
+            return tf.reduce_mean(input_tensor=policy_cross_entropy)
+
         def policy_uniform_loss(target, output):
             uniform = tf.where(tf.greater_equal(target, 0),
                                tf.ones_like(target), tf.zeros_like(target))
@@ -267,7 +435,10 @@ class TFProcess:
                                                         logits=output)
             return tf.reduce_mean(input_tensor=policy_cross_entropy)
 
-        self.policy_uniform_loss_fn = policy_uniform_loss
+        if self.sparse_policy:
+            self.policy_uniform_loss_fn = sparse_policy_uniform_loss
+        else:
+            self.policy_uniform_loss_fn = policy_uniform_loss
 
         q_ratio = self.cfg['training'].get('q_ratio', 0)
         assert 0 <= q_ratio <= 1
@@ -346,36 +517,72 @@ class TFProcess:
 
         self.accuracy_fn = accuracy
 
-        self.avg_policy_loss = []
-        self.avg_value_loss = []
-        self.avg_moves_left_loss = []
-        self.avg_mse_loss = []
-        self.avg_reg_term = []
+        # Sums of the policy, value, mse, moves left losses and reg term
+        # over the batch splits since the last report, kept on the device.
+        # Every replica adds its share of the losses to the sums.
+        with self.strategy.scope():
+            self.train_loss_sums = tf.Variable(
+                tf.zeros(5),
+                trainable=False,
+                aggregation=tf.VariableAggregation.SUM)
+            self.train_loss_count = tf.Variable(
+                0.,
+                trainable=False,
+                aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+            self.grad_norm = tf.Variable(
+                0.,
+                trainable=False,
+                aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
+            # Buffers the gradients of the batch splits are added into in
+            # place, local to each replica.
+            self.grad_buffers = None
+            if self.cfg['training'].get('num_batch_splits', 1) > 1:
+                self.grad_buffers = [
+                    tf.Variable(
+                        tf.zeros_like(w),
+                        trainable=False,
+                        synchronization=tf.VariableSynchronization.ON_READ,
+                        aggregation=tf.VariableAggregation.SUM)
+                    for w in self.model.trainable_weights
+                ]
         self.time_start = None
         self.last_steps = None
+        # Seconds spent waiting for input batches and in the rest of the
+        # training steps since the last report.
+        self.input_time = 0.0
+        self.compute_time = 0.0
+        # False once an input wait was hidden inside a compiled loop.
+        self.input_measured = True
+        # Set once the first training step has created the optimizer slots.
+        self.trained = False
+        # Training steps run in one compiled loop, see steps_per_run.
+        self.steps_per_execution = self.cfg['training'].get(
+            'steps_per_execution', 1)
+        # Average the gradients of the batch splits, rather than sum them
+        # and divide the learning rate by the number of splits.
+        self.average_batch_splits = self.cfg['training'].get(
+            'average_batch_splits', False)
         # Set adaptive learning rate during training
         self.cfg['training']['lr_boundaries'].sort()
         self.warmup_steps = self.cfg['training'].get('warmup_steps', 0)
         self.lr = self.cfg['training']['lr_values'][0]
-        self.test_writer = tf.summary.create_file_writer(
-            os.path.join(os.getcwd(),
-                         "leelalogs/{}-test".format(self.cfg['name'])))
-        self.train_writer = tf.summary.create_file_writer(
-            os.path.join(os.getcwd(),
-                         "leelalogs/{}-train".format(self.cfg['name'])))
+
+        def summary_writer(name):
+            # Without summaries, e.g. in benchmarks, write nothing at all.
+            if not summaries:
+                return tf.summary.create_noop_writer()
+            return tf.summary.create_file_writer(
+                os.path.join(os.getcwd(),
+                             "leelalogs/{}-{}".format(self.cfg['name'],
+                                                      name)))
+
+        self.test_writer = summary_writer('test')
+        self.train_writer = summary_writer('train')
         if vars(self).get('validation_dataset', None) is not None:
-            self.validation_writer = tf.summary.create_file_writer(
-                os.path.join(
-                    os.getcwd(),
-                    "leelalogs/{}-validation".format(self.cfg['name'])))
+            self.validation_writer = summary_writer('validation')
         if self.swa_enabled:
-            self.swa_writer = tf.summary.create_file_writer(
-                os.path.join(os.getcwd(),
-                             "leelalogs/{}-swa-test".format(self.cfg['name'])))
-            self.swa_validation_writer = tf.summary.create_file_writer(
-                os.path.join(
-                    os.getcwd(),
-                    "leelalogs/{}-swa-validation".format(self.cfg['name'])))
+            self.swa_writer = summary_writer('swa-test')
+            self.swa_validation_writer = summary_writer('swa-validation')
         self.checkpoint = tf.train.Checkpoint(optimizer=self.orig_optimizer,
                                               model=self.model,
                                               global_step=self.global_step,
@@ -387,6 +594,13 @@ class TFProcess:
             max_to_keep=50,
             keep_checkpoint_every_n_hours=24,
             checkpoint_name=self.cfg['name'])
+        # Checkpoints and weights are copied to host memory and written on
+        # background threads, so training goes on while they are saved.
+        self.checkpoint_options = tf.train.CheckpointOptions(
+            experimental_enable_async_checkpoint=True)
+        self.save_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='save_weights')
+        self.pending_saves = []
 
     def replace_weights_v2(self, proto_filename, ignore_errors=True):
         self.net.parse_proto(proto_filename)
@@ -485,10 +699,54 @@ class TFProcess:
         # which is not a multiple of total_steps.
         steps = self.global_step.read_value()
         total_steps = self.cfg['training']['total_steps']
-        for _ in range(steps % total_steps, total_steps):
-            self.process_v2(batch_size,
-                            test_batches,
-                            batch_splits=batch_splits)
+        remaining = total_steps - steps % total_steps
+        while remaining > 0:
+            remaining -= self.process_v2(batch_size,
+                                         test_batches,
+                                         batch_splits=batch_splits)
+        self.wait_saves_v2()
+
+    def lr_schedule(self, steps):
+        """
+        Learning rate of the step taken at global step steps, as a tensor
+        function so that compiled training loops can evaluate it.
+        """
+        lr_values = tf.constant(self.cfg['training']['lr_values'],
+                                dtype=tf.float32)
+        lr_boundaries = tf.constant(self.cfg['training']['lr_boundaries'],
+                                    dtype=tf.int64)
+        steps = tf.cast(steps, tf.int64)
+        steps_total = steps % self.cfg['training']['total_steps']
+        # Same index as bisect.bisect_right(lr_boundaries, steps_total).
+        lr = tf.gather(
+            lr_values,
+            tf.reduce_sum(tf.cast(lr_boundaries <= steps_total, tf.int32)))
+        if self.warmup_steps > 0:
+            lr = tf.where(
+                steps < self.warmup_steps,
+                lr * tf.cast(steps + 1, tf.float32) / self.warmup_steps, lr)
+        return lr
+
+    def steps_per_run(self, steps):
+        """
+        Number of steps to run in one go from steps: steps_per_execution,
+        but stopping at the next step that reports, tests or saves.
+        """
+        training = self.cfg['training']
+        intervals = [
+            training['train_avg_report_steps'], training['total_steps'],
+            training['test_steps']
+        ]
+        if self.swa_enabled:
+            intervals.append(training['swa_steps'])
+        if self.validation_dataset is not None:
+            intervals.append(training['validation_steps'])
+        if 'checkpoint_steps' in training:
+            intervals.append(training['checkpoint_steps'])
+        n = self.steps_per_execution
+        for interval in intervals:
+            n = min(n, interval - steps % interval)
+        return n
 
     @tf.function()
     def read_weights(self):
@@ -516,7 +774,7 @@ class TFProcess:
 
             total_loss = self.lossMix(policy_loss, value_loss,
                                       moves_left_loss) + reg_term
-            if self.loss_scale != 1:
+            if self.loss_scale is not None:
                 total_loss = self.optimizer.get_scaled_loss(total_loss)
         
         # Calculate MSE loss for reporting (always needed)
@@ -528,7 +786,81 @@ class TFProcess:
         return policy_loss, value_loss, mse_loss, moves_left_loss, reg_term, tape.gradient(
             total_loss, self.model.trainable_weights)
 
+    @tf.function()
+    def train_step(self, batches):
+        """
+        One optimizer step over batches, a tuple of batch_splits training
+        batches, with the gradients accumulated, clipped and applied and
+        the losses summed for the report, all in one graph. Each replica
+        of the strategy takes its share of every batch.
+        """
+        lr = self.lr_schedule(self.global_step)
+        if not self.average_batch_splits:
+            # Gradients of batch splits are summed, not averaged like usual, so need to scale lr accordingly to correct for this.
+            lr /= len(batches)
+        self.active_lr.assign(lr)
+        self.strategy.run(self.replica_train_step, args=(batches, ))
+
+    def replica_train_step(self, batches):
+        replicas = self.strategy.num_replicas_in_sync
+        batch_splits = len(batches)
+        # The accumulated gradients are this multiple of the mean gradient.
+        grad_multiple = 1 if self.average_batch_splits else batch_splits
+        for i, (x, y, z, q, m) in enumerate(batches):
+            policy_loss, value_loss, mse_loss, moves_left_loss, reg_term, grads = self.process_inner_loop(
+                x, y, z, q, m)
+            if batch_splits > 1:
+                # Accumulate in place, so the gradients of only one split
+                # are alive besides the buffers.
+                for buffer, grad in zip(self.grad_buffers, grads):
+                    if self.average_batch_splits:
+                        grad = grad / batch_splits
+                    if i == 0:
+                        buffer.assign(grad)
+                    else:
+                        buffer.assign_add(grad)
+            # Google's paper scales MSE by 1/4 to a [0, 1] range, so do the same to
+            # get comparable values.
+            mse_loss /= 4.0
+            if not self.wdl:
+                value_loss = tf.constant(0.)
+            # Replicas add their losses, so this sums their mean.
+            self.train_loss_sums.assign_add(
+                tf.stack([
+                    policy_loss, value_loss, mse_loss, moves_left_loss,
+                    reg_term
+                ]) / replicas)
+        self.train_loss_count.assign_add(batch_splits)
+        if batch_splits > 1:
+            grads = [buffer.read_value() for buffer in self.grad_buffers]
+        # Average the gradients over the replicas before clipping, so the
+        # step is the same as on one device.
+        if replicas > 1:
+            grads = tf.distribute.get_replica_context().all_reduce(
+                tf.distribute.ReduceOp.MEAN, grads)
+        if self.loss_scale is not None:
+            grads = self.optimizer.get_unscaled_gradients(grads)
+        max_grad_norm = self.cfg['training'].get('max_grad_norm',
+                                                 10000.0) * grad_multiple
+        grads, grad_norm = tf.clip_by_global_norm(grads, max_grad_norm)
+        self.optimizer.apply_gradients(zip(grads,
+                                           self.model.trainable_weights),
+                                       experimental_aggregate_gradients=False)
+        self.grad_norm.assign(grad_norm / grad_multiple)
+        self.global_step.assign_add(1)
+
+    @tf.function()
+    def train_loop(self, iterator, steps, batch_splits):
+        """
+        Run steps training steps in one graph, reading the batches from
+        iterator inside it.
+        """
+        for _ in tf.range(steps):
+            self.train_step(
+                tuple(next(iterator) for _ in range(batch_splits)))
+
     def process_v2(self, batch_size, test_batches, batch_splits=1):
+        # Runs up to steps_per_execution steps, returns how many it ran.
         if not self.time_start:
             self.time_start = time.time()
 
@@ -557,55 +889,42 @@ class TFProcess:
             raise ValueError(
                 'batch_size must be a multiple of {}'.format(required_factor))
 
-        # Determine learning rate
-        lr_values = self.cfg['training']['lr_values']
-        lr_boundaries = self.cfg['training']['lr_boundaries']
-        steps_total = steps % self.cfg['training']['total_steps']
-        self.lr = lr_values[bisect.bisect_right(lr_boundaries, steps_total)]
-        if self.warmup_steps > 0 and steps < self.warmup_steps:
-            self.lr = self.lr * tf.cast(steps + 1,
-                                        tf.float32) / self.warmup_steps
-
-        # need to add 1 to steps because steps will be incremented after gradient update
-        if (steps +
-                1) % self.cfg['training']['train_avg_report_steps'] == 0 or (
-                    steps + 1) % self.cfg['training']['total_steps'] == 0:
+        # Steps to run before the next report, test or save.
+        run_steps = self.steps_per_run(int(steps))
+
+        # need to add run_steps to steps because steps will be incremented after gradient update
+        if (steps + run_steps
+            ) % self.cfg['training']['train_avg_report_steps'] == 0 or (
+                steps + run_steps) % self.cfg['training']['total_steps'] == 0:
             before_weights = self.read_weights()
 
         # Run training for this batch
-        grads = None
-        for _ in range(batch_splits):
-            x, y, z, q, m = next(self.train_iter)
-            policy_loss, value_loss, mse_loss, moves_left_loss, reg_term, new_grads = self.process_inner_loop(
-                x, y, z, q, m)
-            if not grads:
-                grads = new_grads
-            else:
-                grads = [tf.math.add(a, b) for (a, b) in zip(grads, new_grads)]
-            # Keep running averages
-            # Google's paper scales MSE by 1/4 to a [0, 1] range, so do the same to
-            # get comparable values.
-            mse_loss /= 4.0
-            self.avg_policy_loss.append(policy_loss)
-            if self.wdl:
-                self.avg_value_loss.append(value_loss)
-            if self.moves_left:
-                self.avg_moves_left_loss.append(moves_left_loss)
-            self.avg_mse_loss.append(mse_loss)
-            self.avg_reg_term.append(reg_term)
-        # Gradients of batch splits are summed, not averaged like usual, so need to scale lr accordingly to correct for this.
-        self.active_lr = self.lr / batch_splits
-        if self.loss_scale != 1:
-            grads = self.optimizer.get_unscaled_gradients(grads)
-        max_grad_norm = self.cfg['training'].get('max_grad_norm',
-                                                 10000.0) * batch_splits
-        grads, grad_norm = tf.clip_by_global_norm(grads, max_grad_norm)
-        self.optimizer.apply_gradients(zip(grads,
-                                           self.model.trainable_weights))
+        step_start = time.perf_counter()
+        # Optimizer slots are created by the first step, which can't be
+        # inside a graph loop.
+        if run_steps == 1 or not self.trained:
+            batches = tuple(
+                next(self.train_iter) for _ in range(batch_splits))
+            input_time = time.perf_counter() - step_start
+            self.train_step(batches)
+            self.trained = True
+            run_steps = 1
+        else:
+            # Input waits happen inside the graph, and aren't measured.
+            input_time = None
+            self.train_loop(self.train_iter, tf.constant(run_steps),
+                            batch_splits)
+        if input_time is None:
+            self.input_measured = False
+        else:
+            # Device work runs asynchronously, so a wait for input that
+            # overlaps with it costs nothing. Long waits mean the device idles.
+            self.input_time += input_time
+            self.compute_time += time.perf_counter() - step_start - input_time
 
-        # Update steps.
-        self.global_step.assign_add(1)
         steps = self.global_step.read_value()
+        # Learning rate of the last step taken.
+        self.lr = self.lr_schedule(steps - 1).numpy()
 
         if steps % self.cfg['training'][
                 'train_avg_report_steps'] == 0 or steps % self.cfg['training'][
@@ -620,19 +939,31 @@ class TFProcess:
                 steps_elapsed = steps - self.last_steps
                 speed = batch_size * (tf.cast(steps_elapsed, tf.float32) /
                                       elapsed)
-            avg_policy_loss = np.mean(self.avg_policy_loss or [0])
-            avg_moves_left_loss = np.mean(self.avg_moves_left_loss or [0])
-            avg_value_loss = np.mean(self.avg_value_loss or [0])
-            avg_mse_loss = np.mean(self.avg_mse_loss or [0])
-            avg_reg_term = np.mean(self.avg_reg_term or [0])
+            avg_policy_loss, avg_value_loss, avg_mse_loss, avg_moves_left_loss, avg_reg_term = (
+                self.train_loss_sums.numpy() /
+                max(self.train_loss_count.numpy(), 1))
+            # Fraction of the training loop spent waiting for input.
+            input_bound = None
+            input_report = ""
+            if self.input_measured:
+                input_bound = self.input_time / max(
+                    self.input_time + self.compute_time, 1e-9)
+                input_report = ", {:.0%} input bound".format(input_bound)
             print(
-                "step {}, lr={:g} policy={:g} value={:g} mse={:g} moves={:g} reg={:g} total={:g} ({:g} pos/s)"
+                "step {}, lr={:g} policy={:g} value={:g} mse={:g} moves={:g} reg={:g} total={:g} ({:g} pos/s{})"
                 .format(
                     steps, self.lr, avg_policy_loss, avg_value_loss,
                     avg_mse_loss, avg_moves_left_loss, avg_reg_term,
                     pol_loss_w * avg_policy_loss +
                     val_loss_w * avg_value_loss + avg_reg_term +
-                    moves_loss_w * avg_moves_left_loss, speed))
+                    moves_loss_w * avg_moves_left_loss, speed, input_report))
+            if input_bound is not None and input_bound > self.cfg[
+                    'training'].get('input_bound_warning', 0.5):
+                print(
+                    "Warning: {:.0%} of training time went to waiting for "
+                    "input, the data pipeline limits throughput. Consider "
+                    "more train_workers or worker_decode.".format(
+                        input_bound))
 
             after_weights = self.read_weights()
             with self.train_writer.as_default():
@@ -644,20 +975,25 @@ class TFProcess:
                                       step=steps)
                 tf.summary.scalar("Reg term", avg_reg_term, step=steps)
                 tf.summary.scalar("LR", self.lr, step=steps)
-                tf.summary.scalar("Gradient norm",
-                                  grad_norm / batch_splits,
-                                  step=steps)
+                tf.summary.scalar("Gradient norm", self.grad_norm, step=steps)
                 tf.summary.scalar("MSE Loss", avg_mse_loss, step=steps)
+                if input_bound is not None:
+                    tf.summary.scalar("Input-bound fraction",
+                                      input_bound,
+                                      step=steps)
                 self.compute_update_ratio_v2(before_weights, after_weights,
                                              steps)
+                if self.train_parser is not None and self.time_start:
+                    self.write_input_stats_v2(time_end - self.time_start,
+                                              steps)
             self.train_writer.flush()
             self.time_start = time_end
             self.last_steps = steps
-            self.avg_policy_loss = []
-            self.avg_moves_left_loss = []
-            self.avg_value_loss = []
-            self.avg_mse_loss = []
-            self.avg_reg_term = []
+            self.train_loss_sums.assign(tf.zeros(5))
+            self.train_loss_count.assign(0.)
+            self.input_time = 0.0
+            self.compute_time = 0.0
+            self.input_measured = True
 
         if self.swa_enabled and steps % self.cfg['training']['swa_steps'] == 0:
             self.update_swa_v2()
@@ -683,16 +1019,29 @@ class TFProcess:
                 'checkpoint_steps' in self.cfg['training']
                 and steps % self.cfg['training']['checkpoint_steps'] == 0):
             evaled_steps = steps.numpy()
-            self.manager.save(checkpoint_number=evaled_steps)
-            print("Model saved in file: {}".format(
-                self.manager.latest_checkpoint))
+            save_path = self.manager.save(checkpoint_number=evaled_steps,
+                                          options=self.checkpoint_options)
+            print("Model saved in file: {}".format(save_path))
             path = os.path.join(self.root_dir, self.cfg['name'])
             leela_path = path + "-" + str(evaled_steps)
             swa_path = path + "-swa-" + str(evaled_steps)
             self.net.pb.training_params.training_steps = evaled_steps
-            self.save_leelaz_weights_v2(leela_path)
+            self.save_leelaz_weights_v2(leela_path, background=True)
             if self.swa_enabled:
-                self.save_swa_weights_v2(swa_path)
+                self.save_swa_weights_v2(swa_path, background=True)
+
+        return run_steps
+
+    def write_input_stats_v2(self, elapsed, steps):
+        # Busy fraction of wall time and throughput of each input pipeline
+        # stage, the worker ones summed over the workers.
+        for name, (seconds, items) in self.train_parser.stage_stats().items():
+            tf.summary.scalar("Input {} time".format(name),
+                              seconds / elapsed,
+                              step=steps)
+            tf.summary.scalar("Input {} items/s".format(name),
+                              items / elapsed,
+                              step=steps)
 
     def calculate_swa_summaries_v2(self, test_batches, steps):
         backup = self.read_weights()
@@ -732,6 +1081,20 @@ class TFProcess:
 
         return policy_loss, value_loss, moves_left_loss, mse_loss, policy_accuracy, value_accuracy, moves_left_mean_error, policy_entropy, policy_ul
 
+    @tf.function()
+    def test_step(self, x, y, z, q, m):
+        """
+        calculate_test_summaries_inner_loop on every replica's share of a
+        batch, averaged over the replicas.
+        """
+        results = self.strategy.run(self.calculate_test_summaries_inner_loop,
+                                    args=(x, y, z, q, m))
+        return [
+            self.strategy.reduce(tf.distribute.ReduceOp.MEAN,
+                                 result,
+                                 axis=None) for result in results
+        ]
+
     def calculate_test_summaries_v2(self, test_batches, steps):
         sum_policy_accuracy = 0
         sum_value_accuracy = 0
@@ -744,7 +1107,7 @@ class TFProcess:
         sum_policy_ul = 0
         for _ in range(0, test_batches):
             x, y, z, q, m = next(self.test_iter)
-            policy_loss, value_loss, moves_left_loss, mse_loss, policy_accuracy, value_accuracy, moves_left_mean_error, policy_entropy, policy_ul = self.calculate_test_summaries_inner_loop(
+            policy_loss, value_loss, moves_left_loss, mse_loss, policy_accuracy, value_accuracy, moves_left_mean_error, policy_entropy, policy_ul = self.test_step(
                 x, y, z, q, m)
             sum_policy_accuracy += policy_accuracy
             sum_policy_entropy += policy_entropy
@@ -829,8 +1192,9 @@ class TFProcess:
         sum_policy_entropy = 0
         sum_policy_ul = 0
         counter = 0
-        for (x, y, z, q, m) in self.validation_dataset:
-            policy_loss, value_loss, moves_left_loss, mse_loss, policy_accuracy, value_accuracy, moves_left_mean_error, policy_entropy, policy_ul = self.calculate_test_summaries_inner_loop(
+        for (x, y, z, q, m) in self.distribute_dataset(
+                self.validation_dataset):
+            policy_loss, value_loss, moves_left_loss, mse_loss, policy_accuracy, value_accuracy, moves_left_mean_error, policy_entropy, policy_ul = self.test_step(
                 x, y, z, q, m)
             sum_policy_accuracy += policy_accuracy
             sum_policy_entropy += policy_entropy
@@ -926,20 +1290,66 @@ class TFProcess:
                        (1. / (num + 1.)))
         self.swa_count.assign(min(num + 1., self.swa_max_n))
 
-    def save_swa_weights_v2(self, filename):
-        backup = self.read_weights()
-        for (swa, w) in zip(self.swa_weights, self.model.weights):
-            w.assign(swa.read_value())
-        self.save_leelaz_weights_v2(filename)
-        for (old, w) in zip(backup, self.model.weights):
-            w.assign(old)
+    def save_swa_weights_v2(self, filename, background=False):
+        self.save_leelaz_weights_v2(filename, self.swa_weights, background)
 
-    def save_leelaz_weights_v2(self, filename):
+    def save_leelaz_weights_v2(self, filename, weights=None,
+                               background=False):
+        """
+        Save the model weights, or weights in their place, as a protobuf.
+        The weights and the network description are copied to host memory
+        right away; with background they are then quantized and written on
+        the save thread, see wait_saves_v2().
+        """
+        if weights is None:
+            weights = self.model.weights
         numpy_weights = []
-        for weight in self.model.weights:
-            numpy_weights.append([weight.name, weight.numpy()])
-        self.net.fill_net_v2(numpy_weights)
-        self.net.save_proto(filename)
+        for weight, value in zip(self.model.weights, weights):
+            numpy_weights.append([weight.name, value.numpy()])
+        net = Net()
+        for field in ['min_version', 'format', 'training_params']:
+            getattr(net.pb, field).CopyFrom(getattr(self.net.pb, field))
+
+        def save():
+            net.fill_net_v2(numpy_weights)
+            net.save_proto(filename)
+
+        if not background:
+            save()
+            return
+        # Raise the errors of earlier saves, once.
+        done = [future for future in self.pending_saves if future.done()]
+        self.pending_saves = [
+            future for future in self.pending_saves if future not in done
+        ]
+        for future in done:
+            future.result()
+
+        def report(future):
+            # Print the error when it happens, it is raised again later.
+            if future.exception() is not None:
+                print('Saving {} failed: {}'.format(filename,
+                                                    future.exception()))
+
+        future = self.save_executor.submit(save)
+        future.add_done_callback(report)
+        self.pending_saves.append(future)
+
+    def wait_saves_v2(self):
+        """
+        Wait for the checkpoints and weights being saved in the background,
+        then raise the first error of any of them.
+        """
+        errors = []
+        for future in self.pending_saves:
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+        self.pending_saves = []
+        self.checkpoint.sync()
+        if errors:
+            raise errors[0]
 
     def batch_norm_v2(self, input, name, scale=False):
         if self.renorm_enabled:
@@ -1027,6 +1437,28 @@ class TFProcess:
         return tf.keras.layers.Activation('relu')(tf.keras.layers.add(
             [inputs, out2]))
 
+    def construct_model_v2(self):
+        """
+        Returns the Keras model, computing in the dtype of the global
+        mixed precision policy.
+        """
+        self.l2reg = tf.keras.regularizers.l2(l=0.5 * (0.0001))
+        if self.packed_planes:
+            input_var = tf.keras.Input(shape=(tfpipeline.PACKED_PLANES_SIZE, ),
+                                       dtype=tf.uint8)
+            x_planes = ExpandPlanes(self.INPUT_MODE,
+                                    name='expand_planes')(input_var)
+        else:
+            input_var = tf.keras.Input(shape=(112, 8 * 8))
+            x_planes = input_var
+        x_planes = tf.keras.layers.Reshape([112, 8, 8])(x_planes)
+        policy, value, moves_left = self.construct_net_v2(x_planes)
+        if self.moves_left:
+            outputs = [policy, value, moves_left]
+        else:
+            outputs = [policy, value]
+        return tf.keras.Model(inputs=input_var, outputs=outputs)
+
     def construct_net_v2(self, inputs):
         flow = self.conv_block_v2(inputs,
                                   filter_size=3,
@@ -1118,3 +1550,168 @@ class TFProcess:
             h_fc5 = None
 
         return h_fc1, h_fc3, h_fc5
+
+
+class TFProcessTest(unittest.TestCase):
+    CFG = {
+        'name': 'test',
+        'model': {
+            'filters': 16,
+            'residual_blocks': 2,
+            'se_ratio': 4,
+            'moves_left': 'v1',
+        },
+        'training': {
+            'path': '/tmp',
+            'batch_size': 16,
+        },
+    }
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.planes = rng.randint(2, size=(16, 112, 64)).astype(np.float32)
+
+    def tearDown(self):
+        tf.keras.mixed_precision.set_global_policy('float32')
+
+    def model_outputs(self, precision, weights=None):
+        """
+        Outputs in float32 of a model computing in precision, with weights,
+        or its initial weights. Returns them and the weights.
+        """
+        cfg = dict(self.CFG,
+                   training=dict(self.CFG['training'], precision=precision))
+        model = TFProcess(cfg).construct_model_v2()
+        if weights is not None:
+            model.set_weights(weights)
+        outputs = model(self.planes, training=False)
+        return [tf.cast(x, tf.float32).numpy() for x in outputs
+                ], model.get_weights()
+
+    def test_precision_parity(self):
+        """
+        Test that mixed precision models match the float32 model.
+        """
+        tf.random.set_seed(0)
+        (policy, value, moves_left), weights = self.model_outputs('single')
+        # Log probabilities, as the policy probabilities are all tiny.
+        # Another initialization differs by about 1.
+        for precision, atol in [('mixed_float16', 5e-3), ('bfloat16', 5e-2)]:
+            (lp_policy, lp_value,
+             lp_moves_left), lp_weights = self.model_outputs(
+                 precision, weights)
+            tf.keras.mixed_precision.set_global_policy('float32')
+            # Variables stay in float32
+            self.assertTrue(all(w.dtype == np.float32 for w in lp_weights))
+            np.testing.assert_allclose(tf.nn.log_softmax(lp_policy),
+                                       tf.nn.log_softmax(policy),
+                                       atol=atol)
+            np.testing.assert_allclose(tf.nn.log_softmax(lp_value),
+                                       tf.nn.log_softmax(value),
+                                       atol=atol)
+            np.testing.assert_allclose(lp_moves_left, moves_left, atol=atol)
+
+    def test_average_batch_splits(self):
+        """
+        Test that averaging the gradients of the batch splits takes the same
+        steps as summing them with the learning rate divided.
+        """
+        rng = np.random.RandomState(1)
+        probs = -np.ones((16, 1858), dtype=np.float32)
+        probs[:, :30] = rng.dirichlet(np.ones(30), size=16)
+        wdl = np.eye(3, dtype=np.float32)[rng.randint(3, size=16)]
+        moves_left = rng.randint(200, size=16).astype(np.float32)
+        batches = tuple((self.planes[i:i + 8], probs[i:i + 8], wdl[i:i + 8],
+                         wdl[i:i + 8], moves_left[i:i + 8])
+                        for i in [0, 8])
+        weights = None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for average in [False, True]:
+                tfp = self.init_process(tmpdir,
+                                        num_batch_splits=2,
+                                        average_batch_splits=average)
+                if weights is None:
+                    weights = tfp.model.get_weights()
+                else:
+                    tfp.model.set_weights(weights)
+                for _ in range(2):
+                    tfp.train_step(batches)
+                if average:
+                    for a, b in zip(tfp.model.get_weights(), summed):
+                        np.testing.assert_allclose(a, b, rtol=1e-4, atol=1e-6)
+                summed = tfp.model.get_weights()
+
+    def test_background_save(self):
+        """
+        Test that weights saved in the background match those saved in the
+        foreground, and that saving SWA weights leaves the model alone.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tfp = self.init_process(tmpdir, swa=True, swa_max_n=10)
+            for w, swa in zip(tfp.model.weights, tfp.swa_weights):
+                swa.assign(w * 0.5)
+            weights = tfp.model.get_weights()
+            tfp.save_leelaz_weights_v2(os.path.join(tmpdir, 'sync'))
+            tfp.save_leelaz_weights_v2(os.path.join(tmpdir, 'async'),
+                                       background=True)
+            tfp.save_swa_weights_v2(os.path.join(tmpdir, 'swa'),
+                                    background=True)
+            tfp.manager.save(checkpoint_number=1,
+                             options=tfp.checkpoint_options)
+            # Changed before the background saves are done
+            for w in tfp.model.weights:
+                w.assign(w + 1)
+            tfp.wait_saves_v2()
+            for w, value in zip(tfp.model.weights, weights):
+                w.assign(value)
+
+            def read(name):
+                with gzip.open(os.path.join(tmpdir, name + '.pb.gz')) as f:
+                    return f.read()
+
+            self.assertEqual(read('sync'), read('async'))
+            self.assertNotEqual(read('sync'), read('swa'))
+            tfp.save_swa_weights_v2(os.path.join(tmpdir, 'swa_sync'))
+            self.assertEqual(read('swa'), read('swa_sync'))
+            for a, b in zip(tfp.model.get_weights(), weights):
+                np.testing.assert_array_equal(a, b)
+            self.assertEqual(tfp.manager.latest_checkpoint,
+                             os.path.join(tmpdir, 'test', 'test-1'))
+            # Errors of background saves are raised by wait_saves_v2.
+            tfp.save_leelaz_weights_v2(os.path.join(tmpdir, 'none', 'bad'),
+                                       background=True)
+            with self.assertRaises(OSError):
+                tfp.wait_saves_v2()
+            tfp.wait_saves_v2()
+
+    def init_process(self, tmpdir, **training):
+        """
+        A TFProcess for CFG with the given training settings, initialized
+        to write its checkpoints into tmpdir and no summaries.
+        """
+        training = dict(self.CFG['training'],
+                        path=tmpdir,
+                        lr_values=[0.1],
+                        lr_boundaries=[],
+                        total_steps=10,
+                        policy_loss_weight=1.0,
+                        value_loss_weight=1.0,
+                        moves_left_loss_weight=1.0,
+                        **training)
+        tfp = TFProcess(dict(self.CFG, training=training))
+        tfp.init_net_v2(summaries=False)
+        return tfp
+
+    def test_policy_map(self):
+        """
+        Test that gathering the policy outputs matches the 0/1 policy map.
+        """
+        conv = tf.random.normal([4, 80, 8, 8])
+        expected = tf.matmul(tf.reshape(conv, [-1, 80 * 8 * 8]),
+                             lc0_az_policy_map.make_map())
+        self.assertTrue(
+            np.array_equal(ApplyPolicyMap()(conv).numpy(), expected.numpy()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,6 +7,7 @@
 
 import argparse
 import glob
+import json
 import logging
 import os
 import sys
@@ -14,6 +15,8 @@ import tensorflow as tf
 import yaml
 
 import chunkparser
+import chunkshard
+import tfpipeline
 import tfprocess
 
 # Configure logging
@@ -23,8 +26,36 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Chunk file extensions picked up from input directories
+CHUNK_EXTENSIONS = ('.gz', '.zst', '.lz4', chunkshard.SHARD_EXTENSION)
 
-def find_chunks(input_paths, num_chunks=None, allow_less=False):
+
+def trainer_rank(cfg):
+    """
+    Find the rank of this trainer among those sharing the training data.
+
+    Args:
+        cfg: Configuration dictionary
+
+    Returns:
+        (rank, world_size) from dataset rank and world_size, or else from
+        the TF_CONFIG of multi-worker training, or (0, 1)
+    """
+    dataset_cfg = cfg.get('dataset', {})
+    if 'world_size' in dataset_cfg:
+        return dataset_cfg.get('rank', 0), dataset_cfg['world_size']
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    if 'cluster' not in tf_config:
+        return 0, 1
+    # Chief first, as tf.distribute numbers the workers
+    tasks = [(task_type, index) for task_type in ('chief', 'worker')
+             for index in range(len(tf_config['cluster'].get(task_type, [])))]
+    task = tf_config['task']
+    return tasks.index((task['type'], task['index'])), len(tasks)
+
+
+def find_chunks(input_paths, num_chunks=None, allow_less=False, rank=0,
+                world_size=1):
     """
     Find training chunk files from input paths.
     
@@ -32,22 +63,31 @@ def find_chunks(input_paths, num_chunks=None, allow_less=False):
         input_paths: List of glob patterns or directories
         num_chunks: Maximum number of chunks to use (None = all)
         allow_less: If True, allow fewer chunks than requested
+        rank: Rank of this trainer, which gets 1/world_size of the chunks
+        world_size: Number of trainers sharing the chunks
         
     Returns:
-        List of chunk file paths
+        List of chunk file paths, with (shard, begin, end) triples for runs
+        of blocks of shard files
     """
     chunks = []
     for path in input_paths:
         if os.path.isdir(path):
-            # Find all .gz files in directory
-            pattern = os.path.join(path, "*.gz")
-            chunks.extend(glob.glob(pattern))
+            # Find all compressed chunk files in directory
+            for ext in CHUNK_EXTENSIONS:
+                pattern = os.path.join(path, "*" + ext)
+                chunks.extend(glob.glob(pattern))
         else:
             # Treat as glob pattern
             chunks.extend(glob.glob(path))
     
-    # Sort and limit
+    # Sort, then split shards into chunks of a few blocks, and limit
     chunks = sorted(chunks)
+    chunks = [
+        item for chunk in chunks for item in (
+            chunkshard.shard_chunks(chunk)
+            if chunkshard.is_shard(chunk) else [chunk])
+    ]
     if num_chunks is not None:
         if len(chunks) < num_chunks:
             if not allow_less:
@@ -64,10 +104,37 @@ def find_chunks(input_paths, num_chunks=None, allow_less=False):
         chunks = chunks[:num_chunks]
     
     logger.info(f"Found {len(chunks)} chunk files")
+    # The window is the same for every trainer, only then split
+    return share_chunks(chunks, rank, world_size)
+
+
+def share_chunks(chunks, rank, world_size):
+    """
+    Select the share of this trainer of the chunks.
+
+    Args:
+        chunks: List of chunks, the same in every trainer
+        rank: Rank of this trainer
+        world_size: Number of trainers sharing the chunks
+
+    Returns:
+        Every world_size'th chunk, or all chunks if there are fewer chunks
+        than trainers
+    """
+    if world_size == 1:
+        return chunks
+    if len(chunks) < world_size:
+        logger.warning(
+            f"Found {len(chunks)} chunks for {world_size} trainers. "
+            "Every trainer reads all of them.")
+        return chunks
+    chunks = chunkparser.select_chunks(chunks, rank, world_size)
+    logger.info(f"Using {len(chunks)} chunks as trainer {rank} "
+                f"of {world_size}")
     return chunks
 
 
-def create_dataset(chunks, cfg, is_test=False):
+def create_dataset(chunks, cfg, is_test=False, shard=(0, 1, None)):
     """
     Create a TensorFlow dataset from chunk files.
     
@@ -75,9 +142,12 @@ def create_dataset(chunks, cfg, is_test=False):
         chunks: List of chunk file paths
         cfg: Configuration dictionary
         is_test: If True, create test dataset (no shuffling)
+        shard: (rank, world_size, seed) for the ChunkParser to read only
+            the share of this trainer, redrawn each epoch from seed
         
     Returns:
-        TensorFlow dataset
+        TensorFlow dataset, and the ChunkParser feeding it (None for the
+        tf pipeline)
     """
     dataset_cfg = cfg.get('dataset', {})
     workers = dataset_cfg.get('test_workers' if is_test else 'train_workers', 4)
@@ -99,14 +169,43 @@ def create_dataset(chunks, cfg, is_test=False):
         'canonical_v2_armageddon': 133
     }
     expected_input_format = input_format_map.get(input_mode, 1)
+    packed_planes = model_cfg.get('packed_planes', False)
+    sparse_policy = cfg['training'].get('sparse_policy', False)
     
+    if dataset_cfg.get('pipeline', 'chunkparser') == 'tf':
+        dataset = tfpipeline.make_dataset(
+            chunks,
+            expected_input_format,
+            batch_size,
+            shuffle_size=shuffle_size if not is_test else 1,
+            cycle_length=dataset_cfg.get('tf_cycle_length', 16),
+            packed_planes=packed_planes,
+            sparse_policy=sparse_policy,
+            sample=dataset_cfg.get('sample', 1))
+        return dataset, None
+
+    # parse_function reshapes to a static batch size
+    chunkparser.ChunkParser.BATCH_SIZE = batch_size
+
     # Create parser
     parser = chunkparser.ChunkParser(
         chunks,
         expected_input_format=expected_input_format,
         shuffle_size=shuffle_size if not is_test else 1,
+        sample=dataset_cfg.get('sample', 1),
         batch_size=batch_size,
-        workers=workers
+        workers=workers,
+        worker_decode=dataset_cfg.get('worker_decode', False),
+        transport=dataset_cfg.get('transport', 'pipe'),
+        compact_policy_entries=cfg['training'].get('compact_policy_entries'),
+        chunk_cache_dir=dataset_cfg.get('chunk_cache_dir'),
+        chunk_cache_size=dataset_cfg.get('chunk_cache_mb', 10000) * 1024 * 1024,
+        packed_planes=packed_planes,
+        sparse_policy=sparse_policy,
+        profile_stages=dataset_cfg.get('profile_stages', False),
+        rank=shard[0],
+        world_size=shard[1],
+        shard_seed=shard[2]
     )
     
     # Create dataset from generator
@@ -122,7 +221,8 @@ def create_dataset(chunks, cfg, is_test=False):
     # Parse batches
     def parse_batch(planes, probs, winner, q, plies_left):
         return chunkparser.ChunkParser.parse_function(
-            planes, probs, winner, q, plies_left
+            planes, probs, winner, q, plies_left, packed_planes,
+            sparse_policy
         )
     
     dataset = dataset.map(parse_batch, num_parallel_calls=tf.data.AUTOTUNE)
@@ -156,15 +256,32 @@ def main():
     if use_gpu:
         logger.info(f"Using GPU {cfg['gpu']}")
     
-    # Find training chunks
+    # Trainers sharing the chunks each read their own share. With a
+    # shard_seed the ChunkParser redraws the training shares every epoch,
+    # so it gets all training chunks; otherwise the shares are fixed.
     dataset_cfg = cfg.get('dataset', {})
+    rank, world_size = trainer_rank(cfg)
+    shard_seed = dataset_cfg.get('shard_seed')
+    if dataset_cfg.get('pipeline', 'chunkparser') == 'tf':
+        shard_seed = None
+    if shard_seed is None:
+        train_shard, parser_shard = (rank, world_size), (0, 1, None)
+    else:
+        train_shard, parser_shard = (0, 1), (rank, world_size, shard_seed)
+    if world_size > 1:
+        logger.info(f"Trainer {rank} of {world_size}")
+
+    # Find training chunks
     if 'input_train' in dataset_cfg and 'input_test' in dataset_cfg:
         train_chunks = find_chunks(
             [dataset_cfg['input_train']],
             num_chunks=dataset_cfg.get('num_chunks'),
-            allow_less=dataset_cfg.get('allow_less_chunks', False)
+            allow_less=dataset_cfg.get('allow_less_chunks', False),
+            rank=train_shard[0],
+            world_size=train_shard[1]
         )
-        test_chunks = find_chunks([dataset_cfg['input_test']])
+        test_chunks = find_chunks([dataset_cfg['input_test']],
+                                  rank=rank, world_size=world_size)
     elif 'input' in dataset_cfg:
         all_chunks = find_chunks(
             [dataset_cfg['input']],
@@ -173,8 +290,8 @@ def main():
         )
         train_ratio = dataset_cfg.get('train_ratio', 0.9)
         split_idx = int(len(all_chunks) * train_ratio)
-        train_chunks = all_chunks[:split_idx]
-        test_chunks = all_chunks[split_idx:]
+        train_chunks = share_chunks(all_chunks[:split_idx], *train_shard)
+        test_chunks = share_chunks(all_chunks[split_idx:], rank, world_size)
     else:
         logger.error("No input data specified in configuration")
         sys.exit(1)
@@ -182,10 +299,17 @@ def main():
     if not train_chunks:
         logger.error("No training chunks found!")
         sys.exit(1)
+    if len(train_chunks) < parser_shard[1]:
+        parser_shard = (0, 1, None)
     
+    # Create training process, before TensorFlow sets up its devices
+    logger.info("Initializing training process...")
+    tfp = tfprocess.TFProcess(cfg, gpu=use_gpu)
+
     # Create datasets
     logger.info("Creating training dataset...")
-    train_dataset, train_parser = create_dataset(train_chunks, cfg, is_test=False)
+    train_dataset, train_parser = create_dataset(
+        train_chunks, cfg, is_test=False, shard=parser_shard)
     
     logger.info("Creating test dataset...")
     test_dataset, test_parser = create_dataset(test_chunks, cfg, is_test=True)
@@ -193,14 +317,13 @@ def main():
     # Optional validation dataset
     validation_dataset = None
     if 'input_validation' in dataset_cfg:
-        val_chunks = find_chunks([dataset_cfg['input_validation']])
+        val_chunks = find_chunks([dataset_cfg['input_validation']],
+                                 rank=rank, world_size=world_size)
         if val_chunks:
             validation_dataset, _ = create_dataset(val_chunks, cfg, is_test=True)
     
-    # Create training process
-    logger.info("Initializing training process...")
-    tfp = tfprocess.TFProcess(cfg, gpu=use_gpu)
-    tfp.init_v2(train_dataset, test_dataset, validation_dataset)
+    tfp.init_v2(train_dataset, test_dataset, validation_dataset,
+                train_parser=train_parser)
     
     # Restore checkpoint if resuming
     if args.resume:
@@ -228,8 +351,14 @@ def main():
         raise
     finally:
         # Cleanup
-        train_parser.shutdown()
-        test_parser.shutdown()
+        try:
+            # Background saves may still be running after an interrupt or
+            # error, finish them and raise their errors.
+            tfp.wait_saves_v2()
+        finally:
+            for chunk_parser in [train_parser, test_parser]:
+                if chunk_parser is not None:
+                    chunk_parser.shutdown()
         logger.info("Training completed")
 
 